@@ -0,0 +1,104 @@
+"""
+Per-stage timing, peak memory and correctness benchmarks for color segmentation
+
+Run from the repository root or this folder:
+
+    python color-segmentation/benchmarks/bench_segmentation.py --sizes 1000 4000 --repeat 5
+
+Exits with status 1 if any stage's counts differ from the synthetic ground truth.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from color_segmentation import HSVClassifier, count_objects, erode_labels, segment_image
+from synthetic import make_blob_scene
+from tiled_segmentation import count_objects_tiled
+
+def measure(fn, repeat):
+    """Median wall time over `repeat` runs and peak traced allocation of one extra run"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, float(np.median(times)), peak
+
+def check_counts(objects, expected):
+    counts = {name: result['count'] for name, result in objects.items()}
+    return counts == expected, counts
+
+def run(sizes, repeat, n_per_color, seed):
+    classifier = HSVClassifier()
+    kernel = np.ones((5, 5), np.uint8)
+    rows = []
+
+    for size in sizes:
+        image, expected = make_blob_scene(size, size, n_per_color, seed=seed)
+        labels = classifier.classify(image)
+        eroded = erode_labels(labels, kernel)
+
+        stages = [
+            ('masking', lambda: classifier.classify(image), None),
+            ('erosion', lambda: erode_labels(labels, kernel), None),
+            ('count_objects', lambda: count_objects(eroded, classifier.color_names, separated=True), lambda r: r),
+            ('segment_image', lambda: segment_image(image, classifier), lambda r: r[2]),
+            ('tiled', lambda: count_objects_tiled(image, classifier, tile_size=1024), lambda r: r),
+        ]
+
+        for name, fn, objects_of in stages:
+            result, seconds, peak = measure(fn, repeat)
+            row = {
+                'stage': name,
+                'size': f"{size}x{size}",
+                'megapixels': size * size / 1e6,
+                'seconds': seconds,
+                'mpix_per_second': size * size / 1e6 / seconds if seconds > 0 else float('inf'),
+                'peak_bytes': peak,
+                'correct': None,
+            }
+            if objects_of is not None:
+                row['correct'], row['counts'] = check_counts(objects_of(result), expected)
+            rows.append(row)
+
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the color segmentation stages on synthetic scenes")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 2000, 4000], help="Square image sizes")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per stage")
+    parser.add_argument('--blobs', type=int, default=20, help="Blobs per color")
+    parser.add_argument('--seed', type=int, default=0, help="Scene generator seed")
+    parser.add_argument('--json', help="Also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    rows = run(args.sizes, args.repeat, args.blobs, args.seed)
+
+    print(f"{'stage':<15}{'size':>12}{'ms':>10}{'MP/s':>10}{'peak MB':>10}  correct")
+    for row in rows:
+        correct = '' if row['correct'] is None else ('yes' if row['correct'] else 'NO')
+        print(f"{row['stage']:<15}{row['size']:>12}{row['seconds'] * 1000:>10.1f}"
+              f"{row['mpix_per_second']:>10.1f}{row['peak_bytes'] / 1e6:>10.1f}  {correct}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+    return 1 if any(row['correct'] is False for row in rows) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
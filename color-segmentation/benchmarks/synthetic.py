@@ -0,0 +1,47 @@
+"""
+Deterministic synthetic scenes of colored blobs with known counts
+"""
+
+import cv2
+import numpy as np
+
+# One HSV value inside each color's range of COLOR_RANGES
+BLOB_HSV = {
+    'blue': (115, 200, 200),
+    'yellow': (23, 200, 220),
+    'red': (2, 200, 200),
+    'green': (57, 200, 200),
+    'orange': (10, 200, 220),
+}
+
+def hsv_to_bgr(hsv):
+    pixel = np.array([[hsv]], dtype=np.uint8)
+    return tuple(int(c) for c in cv2.cvtColor(pixel, cv2.COLOR_HSV2BGR)[0, 0])
+
+def make_blob_scene(height, width, n_per_color=20, min_radius=12, max_radius=40, seed=0):
+    """Gray background with non-touching filled circles of every color
+
+    Blobs are placed one per grid cell so none touch, and each is large enough
+    to survive a 5x5 erosion and the default 100 px minimum area. Returns the
+    BGR image and the number of blobs drawn per color.
+    """
+    rng = np.random.default_rng(seed)
+    colors = list(BLOB_HSV)
+    cell = 2 * max_radius + 8
+    rows, cols = height // cell, width // cell
+    n_blobs = min(n_per_color * len(colors), rows * cols)
+
+    image = np.full((height, width, 3), 128, dtype=np.uint8)
+    counts = dict.fromkeys(colors, 0)
+    cells = rng.choice(rows * cols, size=n_blobs, replace=False)
+
+    for i, cell_index in enumerate(cells):
+        color_name = colors[i % len(colors)]
+        radius = int(rng.integers(min_radius, max_radius + 1))
+        row, col = divmod(int(cell_index), cols)
+        center_y = row * cell + cell // 2 + int(rng.integers(-4, 5))
+        center_x = col * cell + cell // 2 + int(rng.integers(-4, 5))
+        cv2.circle(image, (center_x, center_y), radius, hsv_to_bgr(BLOB_HSV[color_name]), -1)
+        counts[color_name] += 1
+
+    return image, counts
@@ -0,0 +1,267 @@
+"""
+Headless batch color segmentation over directories of images
+"""
+
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+
+import instrumentation
+from calibration import load_profile
+from color_segmentation import COLOR_RANGES, DEFAULT_CACHE_DIR, HSVClassifier, load_or_build_lut, segment_image
+from image_io import MAPPED_EXTENSIONS, add_raw_arguments, open_image, raw_options
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff') + MAPPED_EXTENSIONS
+
+# Per-process classifier, created once by the pool initializer
+_classifier = None
+
+def _init_worker(color_ranges, cache_dir, profile_memory=None):
+    global _classifier
+    # One OpenCV thread per process so the pool, not OpenCV, owns the cores
+    cv2.setNumThreads(1)
+    _classifier = HSVClassifier(color_ranges, cache_dir)
+    # Keep spans so they travel back to the parent's recorder with each record
+    if profile_memory is not None:
+        instrumentation.enable(memory=profile_memory, keep=True)
+
+def collect_images(inputs):
+    """Expand directories, glob patterns and file paths into a sorted image list"""
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for name in sorted(os.listdir(item)):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    paths.append(os.path.join(item, name))
+        elif glob.has_magic(item):
+            paths.extend(p for p in sorted(glob.glob(item, recursive=True))
+                         if p.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            paths.append(item)
+    return paths
+
+def summarize(path, image, objects, include_objects=False):
+    """Build a JSON-serializable record from count_objects() output"""
+    counts = {name: result['count'] for name, result in objects.items()}
+    record = {
+        'path': path,
+        'status': 'ok',
+        'height': image.shape[0],
+        'width': image.shape[1],
+        'counts': counts,
+        'total': sum(counts.values()),
+    }
+    if include_objects:
+        record['objects'] = {
+            name: {
+                'areas': result['areas'].tolist(),
+                'centroids': result['centroids'].round(2).tolist(),
+                'boxes': result['boxes'].tolist(),
+            }
+            for name, result in objects.items()
+        }
+    return record
+
+def process_file(path, min_area=100, kernel_size=5, include_objects=False, raw=None):
+    """Segment and count one image file in a worker process
+
+    .npy and raw files are memory-mapped rather than decoded; `raw` holds the
+    open_image() options describing raw dumps.
+    """
+    classifier = _classifier if _classifier is not None else HSVClassifier()
+    with instrumentation.span('decode', path=path):
+        image = open_image(path, **(raw or {}))
+    _, _, objects = segment_image(image, classifier, min_area, kernel_size)
+    record = summarize(path, image, objects, include_objects)
+
+    recorder = instrumentation.active()
+    if recorder is not None:
+        record['spans'] = recorder.drain()
+    return record
+
+def iter_batch(paths, workers=None, retries=1, ordered=False, min_area=100, kernel_size=5,
+               include_objects=False, color_ranges=COLOR_RANGES, cache_dir=DEFAULT_CACHE_DIR, raw=None):
+    """Process images across a process pool, yielding one record per image as it completes
+
+    Failed images are retried up to `retries` times and then yielded with an
+    'error' status instead of aborting the batch. With `ordered` the records are
+    yielded in input order, otherwise in completion order.
+
+    While instrumentation is enabled the workers record spans too, and they are
+    merged into this process's recorder as their records arrive.
+    """
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = workers * 4
+    recorder = instrumentation.active()
+
+    # Build the lookup table once so workers only load it from the cache
+    if cache_dir is not None:
+        load_or_build_lut(color_ranges, cache_dir)
+
+    def make_pool():
+        return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                   initargs=(color_ranges, cache_dir, recorder.memory if recorder else None))
+
+    pending = list(reversed(list(enumerate(paths))))
+    attempts = {}
+    finished = {}
+    next_index = 0
+    pool = make_pool()
+
+    try:
+        in_flight = {}
+        while pending or in_flight:
+            while pending and len(in_flight) < max_in_flight:
+                index, path = pending.pop()
+                attempts[index] = attempts.get(index, 0) + 1
+                future = pool.submit(process_file, path, min_area, kernel_size, include_objects, raw)
+                in_flight[future] = (index, path)
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                index, path = in_flight.pop(future)
+                try:
+                    record = future.result()
+                except Exception as e:
+                    broken = broken or isinstance(e, BrokenProcessPool)
+                    if attempts[index] <= retries:
+                        pending.append((index, path))
+                        continue
+                    record = {'path': path, 'status': 'error', 'error': f"{type(e).__name__}: {str(e)}"}
+
+                spans = record.pop('spans', None)
+                if spans and recorder is not None:
+                    recorder.merge(spans)
+                record['attempts'] = attempts[index]
+                if not ordered:
+                    yield record
+                    continue
+
+                finished[index] = record
+                while next_index in finished:
+                    yield finished.pop(next_index)
+                    next_index += 1
+
+            # A crashed worker breaks the whole pool; requeue its work on a fresh one
+            if broken:
+                for index, path in in_flight.values():
+                    attempts[index] -= 1
+                    pending.append((index, path))
+                in_flight.clear()
+                pool.shutdown(wait=False, cancel_futures=True)
+                pool = make_pool()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+class JSONLWriter:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, record):
+        self.stream.write(json.dumps(record) + "\n")
+        self.stream.flush()
+
+class CSVWriter:
+    def __init__(self, stream, color_names):
+        self.color_names = list(color_names)
+        self.writer = csv.DictWriter(
+            stream,
+            fieldnames=['path', 'status', 'error', 'attempts', 'width', 'height'] + self.color_names + ['total'],
+            extrasaction='ignore'
+        )
+        self.writer.writeheader()
+        self.stream = stream
+
+    def write(self, record):
+        row = dict(record)
+        row.update(record.get('counts', {}))
+        self.writer.writerow(row)
+        self.stream.flush()
+
+def run_batch(paths, output=None, output_format=None, **kwargs):
+    """Run a batch and stream its records to a JSONL or CSV file (stdout by default)
+
+    Returns the number of images that failed.
+    """
+    if output_format is None:
+        output_format = 'csv' if output and output.lower().endswith('.csv') else 'jsonl'
+
+    stream = open(output, 'w', newline='') if output else sys.stdout
+    try:
+        if output_format == 'csv':
+            writer = CSVWriter(stream, kwargs.get('color_ranges', COLOR_RANGES))
+        else:
+            writer = JSONLWriter(stream)
+
+        failures = 0
+        for record in iter_batch(paths, **kwargs):
+            if record['status'] != 'ok':
+                failures += 1
+            writer.write(record)
+        return failures
+    finally:
+        if output:
+            stream.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Count colored objects in batches of images without a GUI")
+    parser.add_argument('inputs', nargs='+', help="Image files, directories or glob patterns")
+    parser.add_argument('-o', '--output', help="Output .jsonl or .csv file (default: JSONL on stdout)")
+    parser.add_argument('--format', choices=['jsonl', 'csv'], dest='output_format',
+                        help="Output format (default: from the output file extension)")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--retries', type=int, default=1, help="Retries per failed image")
+    parser.add_argument('--ordered', action='store_true', help="Emit results in input order")
+    parser.add_argument('--min-area', type=int, default=100, help="Minimum object area in pixels")
+    parser.add_argument('--kernel-size', type=int, default=5, help="Erosion kernel size")
+    parser.add_argument('--objects', action='store_true', dest='include_objects',
+                        help="Include per-object areas, centroids and boxes (JSONL only)")
+    add_raw_arguments(parser)
+    parser.add_argument('--color-profile', help="Color ranges from this calibrated profile (name or .json file)")
+    parser.add_argument('--no-cache', action='store_true', help="Do not cache the lookup table on disk")
+    parser.add_argument('--profile', help="Write per-stage timing spans to this JSONL file")
+    parser.add_argument('--profile-memory', action='store_true', help="Also record bytes allocated per stage")
+    args = parser.parse_args(argv)
+
+    paths = collect_images(args.inputs)
+    if not paths:
+        parser.error("no images found")
+    color_ranges = load_profile(args.color_profile) if args.color_profile else COLOR_RANGES
+
+    profile = open(args.profile, 'w') if args.profile else None
+    recorder = instrumentation.enable(profile, args.profile_memory) if profile else None
+    try:
+        failures = run_batch(
+            paths,
+            output=args.output,
+            output_format=args.output_format,
+            workers=args.workers,
+            retries=args.retries,
+            ordered=args.ordered,
+            min_area=args.min_area,
+            kernel_size=args.kernel_size,
+            include_objects=args.include_objects,
+            color_ranges=color_ranges,
+            cache_dir=None if args.no_cache else DEFAULT_CACHE_DIR,
+            raw=raw_options(args),
+        )
+    finally:
+        if profile:
+            instrumentation.disable()
+            profile.close()
+
+    print(f"Processed {len(paths)} images, {failures} failed", file=sys.stderr)
+    if recorder is not None:
+        print(json.dumps(recorder.summary()), file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,254 @@
+"""
+Fit HSV color ranges from labeled sample images and store them as named profiles
+
+Each sample is an image plus a label map of the same size: 0 for background,
+k for the k-th color and any larger value, such as 255, for pixels to ignore.
+`scene.png` is labeled by `scene.labels.png`, which can be bootstrapped from
+segment_image() output and corrected by hand.
+
+    python src/calibration.py fit line3 samples/ --colors blue yellow red
+    python src/batch_segmentation.py images/ --color-profile line3
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from color_segmentation import COLOR_RANGES, DEFAULT_CACHE_DIR, HSVClassifier, load_or_build_lut, lut_cache_key
+from image_io import open_image
+
+DEFAULT_PROFILE_DIR = os.path.join(os.path.expanduser('~'), '.config', 'color-segmentation', 'profiles')
+LABELS_SUFFIX = '.labels.png'
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+# Classifiers of loaded profiles, keyed by their color ranges
+_classifiers = {}
+
+def find_samples(inputs):
+    """Pair every image with its label map, skipping images that have none"""
+    pairs = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths = [os.path.join(item, name) for name in sorted(os.listdir(item))]
+        else:
+            paths = [item]
+        for path in paths:
+            if path.endswith(LABELS_SUFFIX) or not path.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            labels_path = os.path.splitext(path)[0] + LABELS_SUFFIX
+            if os.path.exists(labels_path):
+                pairs.append((path, labels_path))
+    return pairs
+
+def load_samples(pairs):
+    """Yield (BGR image, label map) for each pair of find_samples()"""
+    for image_path, labels_path in pairs:
+        image = open_image(image_path)
+        labels = open_image(labels_path, cv2.IMREAD_GRAYSCALE)
+        if labels.shape != image.shape[:2]:
+            raise ValueError(f"Label map size does not match its image: {labels_path}")
+        yield image, labels
+
+def accumulate_histograms(samples, n_colors):
+    """Joint hue-saturation and hue-value histograms of every label
+
+    Returns two (n_colors + 1, 180, 256) count arrays, indexed by label with
+    the background at 0. Each sample is binned with one bincount per histogram.
+    """
+    bins = (n_colors + 2) * 180 * 256
+    hue_sat = np.zeros(bins, dtype=np.int64)
+    hue_val = np.zeros(bins, dtype=np.int64)
+
+    for image, labels in samples:
+        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        # Ignored and unknown labels share the extra last slot, dropped below
+        label = np.minimum(labels, n_colors + 1).astype(np.uint32).ravel()
+        base = (label * 180 + hsv[..., 0].ravel()) * 256
+        hue_sat += np.bincount(base + hsv[..., 1].ravel(), minlength=bins)
+        hue_val += np.bincount(base + hsv[..., 2].ravel(), minlength=bins)
+
+    shape = (n_colors + 2, 180, 256)
+    return hue_sat.reshape(shape)[:-1], hue_val.reshape(shape)[:-1]
+
+def hue_arc(hist, coverage):
+    """Shortest circular run of hue bins holding `coverage` of the histogram, as (start, length)"""
+    n = len(hist)
+    cumulative = np.concatenate([[0], np.cumsum(np.tile(hist, 2))])
+    # For every start, the first end whose run reaches the target count
+    ends = np.searchsorted(cumulative, cumulative[:n] + coverage * cumulative[n])
+    lengths = ends - np.arange(n)
+    start = int(np.argmin(lengths))
+    return start, int(lengths[start])
+
+def channel_bounds(positive, negative, coverage, margin):
+    """Lower and upper bound of one channel from the color's and the other pixels' histograms
+
+    The upper bound is the color's upper quantile. Without negatives the lower
+    bound is its lower quantile; with them it is the threshold misclassifying
+    the fewest pixels, taken from the middle of any tie.
+    """
+    tail = (1 - coverage) / 2
+    cumulative = np.cumsum(positive)
+    total = cumulative[-1]
+    lower = int(np.searchsorted(cumulative, tail * total, side='right'))
+    upper = int(np.searchsorted(cumulative, (1 - tail) * total))
+    upper = min(len(positive) - 1, upper + margin)
+
+    if negative[:upper + 1].sum() == 0:
+        return max(0, lower - margin), upper
+
+    # Errors of each threshold t: color pixels below t plus other pixels in [t, upper]
+    missed = np.concatenate([[0], cumulative[:upper]])
+    accepted = np.cumsum(negative[:upper + 1][::-1])[::-1]
+    errors = missed + accepted
+    best = np.flatnonzero(errors == errors.min())
+    return int(best[0] + best[-1]) // 2, upper
+
+def fit_ranges(hue_sat, hue_val, color_names, coverage=0.98, margin=2):
+    """Fit COLOR_RANGES-style (lower, upper) HSV boxes for every color
+
+    Hue is the shortest arc holding `coverage` of the color's pixels, widened
+    by `margin` bins on both sides and split in two where it wraps past 179.
+    Saturation and value bounds are fitted within that arc against the
+    background and the other colors by channel_bounds(), and hue bins at the
+    ends of the arc are dropped where other pixels dominate them.
+    """
+    color_ranges = {}
+    for label, name in enumerate(color_names, start=1):
+        hues = hue_sat[label].sum(axis=1)
+        if hues.sum() == 0:
+            raise ValueError(f"No labeled pixels for color: {name}")
+
+        start, length = hue_arc(hues, coverage)
+        length = min(180, length + 2 * margin)
+        start = (start - margin) % 180 if length < 180 else 0
+        arc = (start + np.arange(length)) % 180
+
+        others = np.ones(len(hue_sat), dtype=bool)
+        others[label] = False
+        s_lower, s_upper = channel_bounds(hue_sat[label][arc].sum(axis=0),
+                                          hue_sat[others][:, arc].sum(axis=(0, 1)), coverage, margin)
+        v_lower, v_upper = channel_bounds(hue_val[label][arc].sum(axis=0),
+                                          hue_val[others][:, arc].sum(axis=(0, 1)), coverage, margin)
+
+        # Trim hue bins off both ends of the arc where, within the saturation
+        # bounds, other pixels outnumber the color's own
+        saturation = slice(s_lower, s_upper + 1)
+        own = hue_sat[label][arc, saturation].sum(axis=1)
+        other = hue_sat[others][:, arc, saturation].sum(axis=(0, 2))
+        kept = np.flatnonzero(own >= other)
+        if len(kept):
+            arc = arc[kept[0]:kept[-1] + 1]
+            start, length = int(arc[0]), len(arc)
+
+        end = start + length - 1
+        if end < 180:
+            hue_spans = [(start, end)]
+        else:
+            hue_spans = [(start, 179), (0, end - 180)]
+        color_ranges[name] = [([h0, s_lower, v_lower], [h1, s_upper, v_upper]) for h0, h1 in hue_spans]
+    return color_ranges
+
+def calibrate(samples, color_names, coverage=0.98, margin=2):
+    """Fit color ranges from an iterable of (BGR image, label map) samples"""
+    hue_sat, hue_val = accumulate_histograms(samples, len(color_names))
+    return fit_ranges(hue_sat, hue_val, color_names, coverage, margin)
+
+def profile_path(name, profile_dir=DEFAULT_PROFILE_DIR):
+    """A profile file: `name` itself if it is a .json path, otherwise <profile_dir>/<name>.json"""
+    if name.endswith('.json'):
+        return name
+    return os.path.join(profile_dir, f"{name}.json")
+
+def save_profile(name, color_ranges, profile_dir=DEFAULT_PROFILE_DIR, cache_dir=DEFAULT_CACHE_DIR, **info):
+    """Store color ranges as a named profile and precompile its lookup table into the cache"""
+    path = profile_path(name, profile_dir)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    profile = dict(info, name=name, color_ranges={
+        color: [[list(map(int, lower)), list(map(int, upper))] for lower, upper in ranges]
+        for color, ranges in color_ranges.items()
+    })
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(profile, f, indent=2)
+    os.replace(tmp_path, path)
+
+    if cache_dir is not None:
+        load_or_build_lut(color_ranges, cache_dir)
+    return path
+
+def load_profile(name, profile_dir=DEFAULT_PROFILE_DIR):
+    """Color ranges of a named profile or profile .json file, in COLOR_RANGES form"""
+    path = profile_path(name, profile_dir)
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except FileNotFoundError:
+        raise ValueError(f"Unknown color profile: {name}")
+    return {color: [(lower, upper) for lower, upper in ranges]
+            for color, ranges in profile['color_ranges'].items()}
+
+def list_profiles(profile_dir=DEFAULT_PROFILE_DIR):
+    if not os.path.isdir(profile_dir):
+        return []
+    return sorted(os.path.splitext(name)[0] for name in os.listdir(profile_dir) if name.endswith('.json'))
+
+def profile_classifier(name, profile_dir=DEFAULT_PROFILE_DIR, cache_dir=DEFAULT_CACHE_DIR):
+    """HSVClassifier of a profile, kept in memory so switching back to it costs nothing
+
+    Assigning the result to a running FrameStream's `classifier` switches
+    profiles between frames.
+    """
+    color_ranges = load_profile(name, profile_dir)
+    key = (lut_cache_key(color_ranges), tuple(color_ranges))
+    if key not in _classifiers:
+        _classifiers[key] = HSVClassifier(color_ranges, cache_dir)
+    return _classifiers[key]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fit HSV color ranges from labeled samples and manage profiles")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    fit = commands.add_parser('fit', help="Fit a profile from images with .labels.png label maps")
+    fit.add_argument('name', help="Profile name, or a .json path")
+    fit.add_argument('inputs', nargs='+', help="Sample images or directories")
+    fit.add_argument('--colors', nargs='+', default=list(COLOR_RANGES),
+                     help="Color names in label order (label 1 is the first)")
+    fit.add_argument('--coverage', type=float, default=0.98, help="Fraction of each color's pixels to cover")
+    fit.add_argument('--margin', type=int, default=2, help="Bins added around the fitted hue and upper bounds")
+    fit.add_argument('--profile-dir', default=DEFAULT_PROFILE_DIR, help="Profile directory")
+    fit.add_argument('--no-cache', action='store_true', help="Do not precompile the lookup table")
+
+    show = commands.add_parser('list', help="List profiles, or print one")
+    show.add_argument('name', nargs='?', help="Profile to print")
+    show.add_argument('--profile-dir', default=DEFAULT_PROFILE_DIR, help="Profile directory")
+    args = parser.parse_args(argv)
+
+    if args.command == 'list':
+        if args.name:
+            print(json.dumps(load_profile(args.name, args.profile_dir)))
+        else:
+            print("\n".join(list_profiles(args.profile_dir)))
+        return 0
+
+    pairs = find_samples(args.inputs)
+    if not pairs:
+        parser.error(f"no images with {LABELS_SUFFIX} label maps found")
+
+    start = time.perf_counter()
+    color_ranges = calibrate(load_samples(pairs), args.colors, args.coverage, args.margin)
+    path = save_profile(args.name, color_ranges, args.profile_dir, None if args.no_cache else DEFAULT_CACHE_DIR,
+                        samples=len(pairs), coverage=args.coverage, margin=args.margin)
+
+    print(json.dumps(color_ranges))
+    print(f"Fitted {len(args.colors)} colors from {len(pairs)} samples in "
+          f"{time.perf_counter() - start:.1f} s, saved to {path}", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
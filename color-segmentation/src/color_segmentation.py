@@ -1,141 +1,318 @@
-
-import cv2
-import numpy as np
-
-def count_objects(segmented_image, color_name):
-    print(f"\nProcessing {color_name} objects...")
-    
-    # Convert to grayscale
-    gray = cv2.cvtColor(segmented_image, cv2.COLOR_BGR2GRAY)
-    print(f"Converted {color_name} image to grayscale")
-    
-    # Threshold to binary
-    _, binary = cv2.threshold(gray, 1, 255, cv2.THRESH_BINARY)
-    print(f"Created binary image for {color_name}")
-    
-    # Find contours
-    contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    print(f"Found {len(contours)} initial contours for {color_name}")
-    
-    # Filter small contours (noise)
-    min_contour_area = 100  # Adjust this threshold as needed
-    valid_contours = [cnt for cnt in contours if cv2.contourArea(cnt) > min_contour_area]
-    print(f"After filtering small contours, found {len(valid_contours)} valid {color_name} objects")
-    
-    # Draw contours for visualization
-    result = segmented_image.copy()
-    cv2.drawContours(result, valid_contours, -1, (0, 255, 0), 2)
-    
-    return len(valid_contours), result, binary
-
-print("Starting image processing...")
-image = cv2.imread('ExamImgQ1.png')
-print("Original image loaded")
-cv2.imshow('1. Original Image', image)
-
-print("\nConverting to HSV color space...")
-hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-
-# Color ranges (same as before)
-lower_colorgreen = np.array([35, 100, 50])
-upper_colorgreen = np.array([80, 255, 255])
-lower_coloryellow = np.array([17, 150, 100])
-upper_coloryellow = np.array([30, 255, 255])
-lower_colorblue = np.array([90, 150, 70])
-upper_colorblue = np.array([140, 255, 255])
-lower_colorred1 = np.array([0, 120, 100])
-upper_colorred1 = np.array([5, 255, 255])
-lower_colorred2 = np.array([160, 120, 100])
-upper_colorred2 = np.array([179, 255, 255])
-lower_colorredorange = np.array([5, 50, 80])
-upper_colorredorange = np.array([16, 255, 255])
-
-print("\nCreating color masks and segmenting images...")
-# Blue
-mask_blue = cv2.inRange(hsv, lower_colorblue, upper_colorblue)
-segmented_image_blue = cv2.bitwise_and(image, image, mask=mask_blue)
-
-# Yellow
-mask_yellow = cv2.inRange(hsv, lower_coloryellow, upper_coloryellow)
-segmented_image_yellow = cv2.bitwise_and(image, image, mask=mask_yellow)
-
-# Red
-mask_red1 = cv2.inRange(hsv, lower_colorred1, upper_colorred1)
-mask_red2 = cv2.inRange(hsv, lower_colorred2, upper_colorred2)
-mask_red = mask_red1 + mask_red2
-segmented_image_red = cv2.bitwise_and(image, image, mask=mask_red)
-
-# Green
-mask1 = cv2.inRange(hsv, lower_colorgreen, upper_colorgreen)
-segmented_image_green = cv2.bitwise_and(image, image, mask=mask1)
-
-# Orange
-mask_orange = cv2.inRange(hsv, lower_colorredorange, upper_colorredorange)
-segmented_image_orange = cv2.bitwise_and(image, image, mask=mask_orange)
-
-# Show segmentation results
-full_seg = segmented_image_blue + segmented_image_green + segmented_image_red + segmented_image_yellow + segmented_image_orange
-cv2.imshow('2. Full Segmentation', full_seg)
-cv2.imshow('2a. Segmented Blue', segmented_image_blue)
-cv2.imshow('2b. Segmented Green', segmented_image_green)
-cv2.imshow('2c. Segmented Red', segmented_image_red)
-cv2.imshow('2d. Segmented Yellow', segmented_image_yellow)
-cv2.imshow('2e. Segmented Orange', segmented_image_orange)
-
-print("\nPerforming erosion operations...")
-kernel = np.ones((5,5), np.uint8)
-
-# Perform erosion
-eroded_orange = cv2.erode(segmented_image_orange, kernel, iterations=1)
-eroded_red = cv2.erode(segmented_image_red, kernel, iterations=1)
-eroded_yellow = cv2.erode(segmented_image_yellow, kernel, iterations=1)
-eroded_green = cv2.erode(segmented_image_green, kernel, iterations=1)
-eroded_blue = cv2.erode(segmented_image_blue, kernel, iterations=1)
-
-# Show erosion results
-full_eroded = eroded_orange + eroded_red + eroded_yellow + eroded_green + eroded_blue
-cv2.imshow('3. Full Erosion', full_eroded)
-cv2.imshow('3a. Eroded Blue', eroded_blue)
-cv2.imshow('3b. Eroded Green', eroded_green)
-cv2.imshow('3c. Eroded Red', eroded_red)
-cv2.imshow('3d. Eroded Yellow', eroded_yellow)
-cv2.imshow('3e. Eroded Orange', eroded_orange)
-
-print("\nCounting objects and drawing contours...")
-# Count objects for each color
-orange_count, orange_contours, orange_binary = count_objects(eroded_orange, "orange")
-red_count, red_contours, red_binary = count_objects(eroded_red, "red")
-yellow_count, yellow_contours, yellow_binary = count_objects(eroded_yellow, "yellow")
-green_count, green_contours, green_binary = count_objects(eroded_green, "green")
-blue_count, blue_contours, blue_binary = count_objects(eroded_blue, "blue")
-
-# Show contour results
-full_contours = orange_contours + red_contours + yellow_contours + green_contours + blue_contours
-cv2.imshow('4. Full Contours', full_contours)
-cv2.imshow('4a. Blue Contours', blue_contours)
-cv2.imshow('4b. Green Contours', green_contours)
-cv2.imshow('4c. Red Contours', red_contours)
-cv2.imshow('4d. Yellow Contours', yellow_contours)
-cv2.imshow('4e. Orange Contours', orange_contours)
-
-
-print("\nFinal Results:")
-print("=" * 20)
-print(f"Number of orange objects: {orange_count}")
-print(f"Number of red objects: {red_count}")
-print(f"Number of yellow objects: {yellow_count}")
-print(f"Number of green objects: {green_count}")
-print(f"Number of blue objects: {blue_count}")
-print("-" * 20)
-print(f"Total number of objects: {orange_count + red_count + yellow_count + green_count + blue_count}")
-print("=" * 20)
-
-print("\nDisplayed windows show:")
-print("1. Original Image")
-print("2. Segmentation Results (Full + Individual Colors)")
-print("3. Erosion Results (Full + Individual Colors)")
-print("4. Contour Results (Full + Individual Colors)")
-print("5. Binary Results (Full + Individual Colors)")
-
-cv2.waitKey(0)
-cv2.destroyAllWindows()
\ No newline at end of file
+import hashlib
+import json
+import os
+import sys
+
+import cv2
+import numpy as np
+
+from image_io import open_image
+from instrumentation import instrumented
+
+# HSV ranges per color as (lower, upper) pairs. Labels follow this order
+# (1 = first color, 0 = background) and the earlier color wins where ranges overlap.
+COLOR_RANGES = {
+    'blue': [([90, 150, 70], [140, 255, 255])],
+    'yellow': [([17, 150, 100], [30, 255, 255])],
+    'red': [([0, 120, 100], [5, 255, 255]), ([160, 120, 100], [179, 255, 255])],
+    'green': [([35, 100, 50], [80, 255, 255])],
+    'orange': [([5, 50, 80], [16, 255, 255])],
+}
+
+LUT_SHAPE = (180, 256, 256)
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'color-segmentation')
+
+def lut_cache_key(color_ranges):
+    """Stable hash of a color range configuration"""
+    config = [[name, [[list(map(int, lower)), list(map(int, upper))] for lower, upper in ranges]]
+              for name, ranges in color_ranges.items()]
+    return hashlib.sha1(json.dumps(config).encode('utf-8')).hexdigest()[:16]
+
+def build_lut(color_ranges):
+    """Build a 180x256x256 HSV-to-label table from the color ranges"""
+    lut = np.zeros(LUT_SHAPE, dtype=np.uint8)
+    labelled = list(enumerate(color_ranges.items(), start=1))
+
+    # Paint in reverse so earlier colors overwrite later ones on overlaps
+    for label, (name, ranges) in reversed(labelled):
+        for lower, upper in ranges:
+            lut[lower[0]:upper[0] + 1, lower[1]:upper[1] + 1, lower[2]:upper[2] + 1] = label
+
+    return lut
+
+def load_or_build_lut(color_ranges, cache_dir=DEFAULT_CACHE_DIR):
+    """Load the lookup table from the disk cache, building and storing it on a miss"""
+    if cache_dir is None:
+        return build_lut(color_ranges)
+
+    path = os.path.join(cache_dir, f"hsv_lut_{lut_cache_key(color_ranges)}.npy")
+    try:
+        lut = np.load(path)
+        if lut.shape == LUT_SHAPE and lut.dtype == np.uint8:
+            return lut
+    except (OSError, ValueError):
+        pass
+
+    lut = build_lut(color_ranges)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write then rename so concurrent readers never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, lut)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not cache lookup table: {str(e)}")
+
+    return lut
+
+class HSVClassifier:
+    """Label a whole frame by color with a single gather into a precomputed HSV table"""
+
+    def __init__(self, color_ranges=COLOR_RANGES, cache_dir=DEFAULT_CACHE_DIR):
+        self.color_ranges = color_ranges
+        self.color_names = list(color_ranges)
+        self.lut = load_or_build_lut(color_ranges, cache_dir)
+        self._flat_lut = self.lut.ravel()
+
+    def label_of(self, color_name):
+        return self.color_names.index(color_name) + 1
+
+    def classify_hsv(self, hsv, out=None, index=None):
+        """Return a uint8 label map for an 8-bit HSV image"""
+        # Flat table index: (h << 16) | (s << 8) | v
+        if index is None:
+            index = hsv[..., 0].astype(np.uint32)
+        else:
+            np.copyto(index, hsv[..., 0])
+        index <<= 8
+        index |= hsv[..., 1]
+        index <<= 8
+        index |= hsv[..., 2]
+
+        if out is None:
+            out = np.empty(index.shape, dtype=np.uint8)
+        return np.take(self._flat_lut, index, out=out, mode='clip')
+
+    @instrumented('masking')
+    def classify(self, image, out=None, hsv=None, index=None):
+        """Return a uint8 label map for a BGR image"""
+        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV, dst=hsv)
+        return self.classify_hsv(hsv, out=out, index=index)
+
+    def mask(self, labels, color_name):
+        """Binary 0/255 mask of one color from a label map"""
+        return cv2.compare(labels, self.label_of(color_name), cv2.CMP_EQ)
+
+def count_mask(mask, min_area=100, connectivity=8, cc_labels=None):
+    """Find objects in a binary mask with one connected-components pass"""
+    _, _, stats, centroids = cv2.connectedComponentsWithStats(mask, labels=cc_labels, connectivity=connectivity)
+
+    # Drop the background component and filter small components (noise)
+    stats, centroids = stats[1:], centroids[1:]
+    keep = stats[:, cv2.CC_STAT_AREA] > min_area
+
+    return {
+        'count': int(np.count_nonzero(keep)),
+        'areas': stats[keep, cv2.CC_STAT_AREA],
+        'centroids': centroids[keep],
+        'boxes': stats[keep, :cv2.CC_STAT_AREA],
+    }
+
+def component_colors(labels, cc_labels, stats):
+    """Label value of every connected component, read from one pixel on its top row
+
+    Components must each cover a single label value. Only the top row of each
+    bounding box is scanned, so the cost is independent of the image size.
+    """
+    n = len(stats)
+    tops, lefts, widths = (stats[1:, i] for i in (cv2.CC_STAT_TOP, cv2.CC_STAT_LEFT, cv2.CC_STAT_WIDTH))
+    ids = np.repeat(np.arange(1, n), widths)
+    ys = np.repeat(tops, widths)
+    xs = np.repeat(lefts, widths) + np.arange(len(ids)) - np.repeat(np.cumsum(widths) - widths, widths)
+
+    # A component's top row always contains one of its pixels; take the first
+    hits = np.flatnonzero(cc_labels[ys, xs] == ids)
+    first = hits[np.r_[True, ids[hits[1:]] != ids[hits[:-1]]]] if len(hits) else hits
+
+    colors = np.zeros(n, dtype=labels.dtype)
+    colors[ids[first]] = labels[ys[first], xs[first]]
+    return colors
+
+@instrumented('counting')
+def count_objects(labels, color_names, min_area=100, connectivity=8, buffers=None, separated=False):
+    """Count objects of every color in a label map
+
+    Returns a dict mapping each color name to its object count and per-object
+    areas, centroids and (x, y, w, h) bounding boxes as NumPy arrays.
+
+    With `separated` all colors are labelled in a single connected-components
+    pass. This is only valid when regions of different colors never touch, as
+    after erode_labels() with a kernel of at least 3x3.
+    """
+    mask = buffers.mask if buffers is not None else None
+    cc_labels = buffers.cc_labels if buffers is not None else None
+
+    if not separated:
+        results = {}
+        for label, color_name in enumerate(color_names, start=1):
+            mask = cv2.compare(labels, label, cv2.CMP_EQ, dst=mask)
+            results[color_name] = count_mask(mask, min_area, connectivity, cc_labels)
+        return results
+
+    mask = cv2.compare(labels, 0, cv2.CMP_GT, dst=mask)
+    _, cc_labels, stats, centroids = cv2.connectedComponentsWithStats(mask, labels=cc_labels,
+                                                                      connectivity=connectivity)
+    colors = component_colors(labels, cc_labels, stats)
+    large = stats[:, cv2.CC_STAT_AREA] > min_area
+    large[0] = False
+
+    # Components are numbered in raster order either way, so every color keeps its per-mask order
+    results = {}
+    for label, color_name in enumerate(color_names, start=1):
+        keep = large & (colors == label)
+        results[color_name] = {
+            'count': int(np.count_nonzero(keep)),
+            'areas': stats[keep, cv2.CC_STAT_AREA],
+            'centroids': centroids[keep],
+            'boxes': stats[keep, :cv2.CC_STAT_AREA],
+        }
+    return results
+
+def draw_objects(image, objects, color=(0, 255, 0), thickness=2):
+    """Draw the bounding boxes of counted objects on a copy of the image"""
+    result = image.copy()
+    for x, y, w, h in objects['boxes']:
+        cv2.rectangle(result, (int(x), int(y)), (int(x + w - 1), int(y + h - 1)), color, thickness)
+    return result
+
+def colorize(image, labels, label=None):
+    """Copy of the image showing only the pixels of one label, or of every color by default"""
+    if label is None:
+        mask = cv2.compare(labels, 0, cv2.CMP_GT)
+    else:
+        mask = cv2.compare(labels, label, cv2.CMP_EQ)
+    return cv2.bitwise_and(image, image, mask=mask)
+
+@instrumented('erosion')
+def erode_labels(labels, kernel, buffers=None):
+    """Erode each color region of a label map independently
+
+    A pixel keeps its color only if every pixel under the kernel has that
+    color, i.e. where the minimum and maximum label under the kernel agree, so
+    all colors are eroded together in one erode and one dilate of the label map.
+    """
+    if buffers is None:
+        eroded_labels, label_max, agree = None, None, None
+    else:
+        eroded_labels, label_max, agree = buffers.eroded_labels, buffers.mask, buffers.eroded_mask
+
+    eroded_labels = cv2.erode(labels, kernel, dst=eroded_labels)
+    label_max = cv2.dilate(labels, kernel, dst=label_max)
+    agree = cv2.compare(eroded_labels, label_max, cv2.CMP_EQ, dst=agree)
+    return cv2.bitwise_and(eroded_labels, agree, dst=eroded_labels)
+
+class SegmentationBuffers:
+    """Per-frame arrays reused across frames of the same size
+
+    Label maps returned while using these buffers are overwritten by the next
+    frame, so copy them if they need to outlive it.
+    """
+
+    def __init__(self, shape=None):
+        self.shape = None
+        if shape is not None:
+            self.ensure(shape)
+
+    def ensure(self, shape):
+        """(Re)allocate the buffers if the frame size changed"""
+        shape = tuple(shape[:2])
+        if shape != self.shape:
+            self.shape = shape
+            self.hsv = np.empty(shape + (3,), dtype=np.uint8)
+            self.index = np.empty(shape, dtype=np.uint32)
+            self.labels = np.empty(shape, dtype=np.uint8)
+            self.eroded_labels = np.empty(shape, dtype=np.uint8)
+            self.mask = np.empty(shape, dtype=np.uint8)
+            self.eroded_mask = np.empty(shape, dtype=np.uint8)
+            self.cc_labels = np.empty(shape, dtype=np.int32)
+        return self
+
+@instrumented('segmentation')
+def segment_image(image, classifier, min_area=100, kernel_size=5, buffers=None):
+    """Label, erode and count the objects of a BGR image without opening any window
+
+    Returns the label map, the eroded label map and the per-color objects from
+    count_objects(). Pass a SegmentationBuffers to avoid per-call allocations.
+    """
+    kernel = np.ones((kernel_size, kernel_size), np.uint8)
+    if buffers is None:
+        labels = classifier.classify(image)
+    else:
+        buffers.ensure(image.shape)
+        labels = classifier.classify(image, out=buffers.labels, hsv=buffers.hsv, index=buffers.index)
+
+    eroded_labels = erode_labels(labels, kernel, buffers)
+    objects = count_objects(eroded_labels, classifier.color_names, min_area, buffers=buffers,
+                            separated=kernel_size >= 3)
+    return labels, eroded_labels, objects
+
+def main(image_path='ExamImgQ1.png', color_profile=None):
+    image = open_image(image_path)
+    cv2.imshow('1. Original Image', image)
+
+    if color_profile is not None:
+        from calibration import profile_classifier
+        classifier = profile_classifier(color_profile)
+    else:
+        classifier = HSVClassifier()
+    labels = classifier.classify(image)
+
+    # Erode all colors together on the label map and count them in one connected-components pass
+    kernel = np.ones((5,5), np.uint8)
+    eroded_labels = erode_labels(labels, kernel)
+    objects = count_objects(eroded_labels, classifier.color_names, separated=True)
+
+    # Colored views are only built here, for display, one window per color of the classifier
+    display_order = [(chr(ord('a') + i), color_name) for i, color_name in enumerate(classifier.color_names)]
+
+    # Show segmentation results
+    cv2.imshow('2. Full Segmentation', colorize(image, labels))
+    for suffix, color_name in display_order:
+        cv2.imshow(f'2{suffix}. Segmented {color_name.title()}',
+                   colorize(image, labels, classifier.label_of(color_name)))
+
+    # Show erosion results
+    cv2.imshow('3. Full Erosion', colorize(image, eroded_labels))
+    for suffix, color_name in display_order:
+        cv2.imshow(f'3{suffix}. Eroded {color_name.title()}',
+                   colorize(image, eroded_labels, classifier.label_of(color_name)))
+
+    # Show contour results
+    full_contours = colorize(image, eroded_labels)
+    for suffix, color_name in display_order:
+        full_contours = draw_objects(full_contours, objects[color_name])
+        cv2.imshow(f'4{suffix}. {color_name.title()} Contours',
+                   draw_objects(colorize(image, eroded_labels, classifier.label_of(color_name)), objects[color_name]))
+    cv2.imshow('4. Full Contours', full_contours)
+
+    print("\nFinal Results:")
+    print("=" * 20)
+    for color_name in classifier.color_names:
+        print(f"Number of {color_name} objects: {objects[color_name]['count']}")
+    print("-" * 20)
+    print(f"Total number of objects: {sum(result['count'] for result in objects.values())}")
+    print("=" * 20)
+
+    print("\nDisplayed windows show:")
+    print("1. Original Image")
+    print("2. Segmentation Results (Full + Individual Colors)")
+    print("3. Erosion Results (Full + Individual Colors)")
+    print("4. Contour Results (Full + Individual Colors)")
+    print("5. Binary Results (Full + Individual Colors)")
+
+    cv2.waitKey(0)
+    cv2.destroyAllWindows()
+
+if __name__ == "__main__":
+    main(*sys.argv[1:3])
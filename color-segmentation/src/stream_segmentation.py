@@ -0,0 +1,243 @@
+"""
+Streaming color segmentation for video files and live cameras
+"""
+
+import argparse
+import collections
+import json
+import queue
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import instrumentation
+from calibration import profile_classifier
+from color_segmentation import HSVClassifier, SegmentationBuffers, segment_image
+
+DROP_POLICIES = ('block', 'drop-oldest', 'drop-newest')
+
+class FrameStream:
+    """Segment and count objects in frames from a cv2.VideoCapture source
+
+    A producer thread decodes frames into a bounded queue and a pool of worker
+    threads segments them, each reusing its own preallocated buffers. When the
+    queue is full the drop policy decides what happens:
+
+    - 'block': wait for room, never dropping frames (recorded video)
+    - 'drop-oldest': discard the oldest queued frame (live cameras)
+    - 'drop-newest': discard the frame that was just decoded
+
+    Frames older than `max_age` seconds when a worker picks them up are also
+    dropped as stale.
+    """
+
+    def __init__(self, source, workers=2, queue_size=4, drop_policy='drop-oldest', max_age=None,
+                 min_area=100, kernel_size=5, classifier=None):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy: {drop_policy}")
+
+        self.source = source
+        self.workers = workers
+        self.drop_policy = drop_policy
+        self.max_age = max_age
+        self.min_area = min_area
+        self.kernel_size = kernel_size
+        self.classifier = classifier if classifier is not None else HSVClassifier()
+
+        self._frames = queue.Queue(maxsize=queue_size)
+        self._results = queue.Queue()
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+        self.decoded = 0
+        self.processed = 0
+        self.dropped = 0
+        self.stale = 0
+        self.start_time = None
+        self.end_time = None
+        self.total_latency = 0.0
+        self.latencies = collections.deque(maxlen=10000)
+
+    def start(self):
+        capture = cv2.VideoCapture(self.source)
+        if not capture.isOpened():
+            raise ValueError(f"Failed to open video source: {self.source}")
+
+        self.start_time = time.perf_counter()
+        self._threads = [threading.Thread(target=self._produce, args=(capture,), daemon=True)]
+        self._threads += [threading.Thread(target=self._work, daemon=True) for _ in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """Stop decoding; frames already queued are still processed"""
+        self._stop.set()
+
+    def _put(self, item):
+        if self.drop_policy == 'block':
+            while not self._stop.is_set():
+                try:
+                    self._frames.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+        elif self.drop_policy == 'drop-newest':
+            try:
+                self._frames.put_nowait(item)
+            except queue.Full:
+                self._count_drop()
+        else:
+            while True:
+                try:
+                    self._frames.put_nowait(item)
+                    return
+                except queue.Full:
+                    try:
+                        self._frames.get_nowait()
+                        self._count_drop()
+                    except queue.Empty:
+                        pass
+
+    def _count_drop(self):
+        with self._lock:
+            self.dropped += 1
+
+    def _produce(self, capture):
+        try:
+            index = 0
+            while not self._stop.is_set():
+                with instrumentation.span('decode'):
+                    ok, frame = capture.read()
+                if not ok:
+                    break
+                with self._lock:
+                    self.decoded += 1
+                self._put((index, time.perf_counter(), frame))
+                index += 1
+        finally:
+            capture.release()
+            # One sentinel per worker; these must not be dropped
+            for _ in range(self.workers):
+                self._frames.put(None)
+
+    def _work(self):
+        buffers = SegmentationBuffers()
+        try:
+            while True:
+                item = self._frames.get()
+                if item is None:
+                    break
+
+                index, captured, frame = item
+                if self.max_age is not None and time.perf_counter() - captured > self.max_age:
+                    with self._lock:
+                        self.stale += 1
+                    continue
+
+                _, _, objects = segment_image(frame, self.classifier, self.min_area, self.kernel_size, buffers)
+                done = time.perf_counter()
+                latency = done - captured
+
+                with self._lock:
+                    self.processed += 1
+                    self.total_latency += latency
+                    self.latencies.append(latency)
+                    self.end_time = done
+
+                self._results.put({
+                    'frame': index,
+                    'latency': latency,
+                    'counts': {name: result['count'] for name, result in objects.items()},
+                    'objects': objects,
+                })
+        finally:
+            self._results.put(None)
+
+    def results(self):
+        """Yield per-frame results in completion order until the stream ends"""
+        remaining = self.workers
+        while remaining:
+            result = self._results.get()
+            if result is None:
+                remaining -= 1
+            else:
+                yield result
+
+    def stats(self):
+        """Sustained throughput and end-to-end latency so far"""
+        with self._lock:
+            elapsed = (self.end_time or time.perf_counter()) - self.start_time if self.start_time else 0.0
+            latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+            return {
+                'decoded': self.decoded,
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'stale': self.stale,
+                'fps': self.processed / elapsed if elapsed > 0 else 0.0,
+                'latency_mean': self.total_latency / self.processed if self.processed else 0.0,
+                'latency_p50': float(np.percentile(latencies, 50)),
+                'latency_p95': float(np.percentile(latencies, 95)),
+                'latency_max': float(latencies.max()),
+            }
+
+def parse_source(source):
+    """Camera indices are given as integers, everything else is a file or URL"""
+    return int(source) if source.isdigit() else source
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Count colored objects in a video file or camera feed")
+    parser.add_argument('source', help="Video file, stream URL or camera index")
+    parser.add_argument('-j', '--workers', type=int, default=2, help="Worker threads")
+    parser.add_argument('--queue-size', type=int, default=4, help="Maximum decoded frames waiting for a worker")
+    parser.add_argument('--drop-policy', choices=DROP_POLICIES, default=None,
+                        help="What to do when the queue is full (default: block for files, drop-oldest for cameras)")
+    parser.add_argument('--max-age', type=float, default=None, help="Drop frames older than this many seconds")
+    parser.add_argument('--min-area', type=int, default=100, help="Minimum object area in pixels")
+    parser.add_argument('--kernel-size', type=int, default=5, help="Erosion kernel size")
+    parser.add_argument('--color-profile', help="Color ranges from this calibrated profile (name or .json file)")
+    parser.add_argument('--report-every', type=float, default=5.0, help="Seconds between stats reports")
+    parser.add_argument('--frames', action='store_true', help="Print one JSON line per processed frame")
+    parser.add_argument('--profile', help="Write per-stage timing spans to this JSONL file")
+    parser.add_argument('--profile-memory', action='store_true', help="Also record bytes allocated per stage")
+    args = parser.parse_args(argv)
+
+    source = parse_source(args.source)
+    drop_policy = args.drop_policy or ('drop-oldest' if isinstance(source, int) else 'block')
+
+    # The worker threads share the cores, so keep OpenCV itself single-threaded
+    cv2.setNumThreads(1)
+    stream = FrameStream(source, workers=args.workers, queue_size=args.queue_size, drop_policy=drop_policy,
+                         max_age=args.max_age, min_area=args.min_area, kernel_size=args.kernel_size,
+                         classifier=profile_classifier(args.color_profile) if args.color_profile else None)
+    profile = open(args.profile, 'w') if args.profile else None
+    recorder = instrumentation.enable(profile, args.profile_memory) if profile else None
+    stream.start()
+
+    last_report = time.perf_counter()
+    try:
+        for result in stream.results():
+            if args.frames:
+                print(json.dumps({k: result[k] for k in ('frame', 'latency', 'counts')}), flush=True)
+            if time.perf_counter() - last_report >= args.report_every:
+                print(json.dumps(stream.stats()), file=sys.stderr, flush=True)
+                last_report = time.perf_counter()
+    except KeyboardInterrupt:
+        stream.stop()
+        for _ in stream.results():
+            pass
+    finally:
+        if profile:
+            instrumentation.disable()
+            profile.close()
+
+    print(json.dumps(stream.stats()), file=sys.stderr)
+    if recorder is not None:
+        print(json.dumps(recorder.summary()), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
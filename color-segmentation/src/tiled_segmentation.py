@@ -0,0 +1,262 @@
+"""
+Tiled, memory-bounded color segmentation for very large images
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import instrumentation
+from calibration import profile_classifier
+from color_segmentation import HSVClassifier, SegmentationBuffers, component_colors, erode_labels
+from image_io import add_raw_arguments, create_output, open_image, raw_options
+
+def iter_tiles(height, width, tile_size):
+    """Yield (row, col, y0, y1, x0, x1) core regions covering the image"""
+    for row, y0 in enumerate(range(0, height, tile_size)):
+        for col, x0 in enumerate(range(0, width, tile_size)):
+            yield row, col, y0, min(y0 + tile_size, height), x0, min(x0 + tile_size, width)
+
+def _label_per_color(core, n_colors, connectivity):
+    """Component ids, colors, stats and centroids of a label map whose colors may touch"""
+    colors, stats, centroids = [], [], []
+    ids = np.zeros(core.shape, dtype=np.int32)
+    offset = 0
+    for label in range(1, n_colors + 1):
+        mask = cv2.compare(core, label, cv2.CMP_EQ)
+        n, cc_labels, cc_stats, cc_centroids = cv2.connectedComponentsWithStats(mask, connectivity=connectivity)
+        if n <= 1:
+            continue
+        # Tile-wide component ids: 1..n-1 for this color, shifted past earlier colors
+        np.add(cc_labels, offset, out=ids, where=cc_labels > 0)
+        colors.append(np.full(n - 1, label, dtype=np.uint8))
+        stats.append(cc_stats[1:])
+        centroids.append(cc_centroids[1:])
+        offset += n - 1
+
+    if not offset:
+        return ids, np.zeros(0, dtype=np.uint8), np.zeros((0, 5), dtype=np.int64), np.zeros((0, 2))
+    return ids, np.concatenate(colors), np.concatenate(stats).astype(np.int64), np.concatenate(centroids)
+
+def segment_tile(image, region, classifier, kernel, connectivity=8, buffers=None, labels_out=None):
+    """Label, erode and find components in the core of one tile
+
+    The tile is read with a halo of kernel_size // 2 pixels so erosion of the
+    core is identical to eroding the full image. Returns per-component stats in
+    global coordinates plus the component ids along the four core edges, which
+    merge_tiles() uses to join components across seams. The eroded core labels
+    are also written into `labels_out` when given.
+    """
+    _, _, y0, y1, x0, x1 = region
+    height, width = image.shape[:2]
+    halo = kernel.shape[0] // 2
+    hy0, hy1 = max(0, y0 - halo), min(height, y1 + halo)
+    hx0, hx1 = max(0, x0 - halo), min(width, x1 + halo)
+
+    tile = np.ascontiguousarray(image[hy0:hy1, hx0:hx1])
+    if buffers is not None:
+        buffers.ensure(tile.shape)
+        labels = classifier.classify(tile, out=buffers.labels, hsv=buffers.hsv, index=buffers.index)
+    else:
+        labels = classifier.classify(tile)
+    eroded = erode_labels(labels, kernel, buffers)
+    core = np.ascontiguousarray(eroded[y0 - hy0:y1 - hy0, x0 - hx0:x1 - hx0])
+    if labels_out is not None:
+        labels_out[y0:y1, x0:x1] = core
+
+    with instrumentation.span('counting', core):
+        if min(kernel.shape) >= 3:
+            # Eroded colors never touch, so one pass labels every color with tile-wide ids
+            mask = cv2.compare(core, 0, cv2.CMP_GT)
+            _, ids, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=connectivity)
+            colors = component_colors(core, ids, stats)[1:]
+            stats = stats[1:].astype(np.int64)
+            centroids = centroids[1:]
+        else:
+            ids, colors, stats, centroids = _label_per_color(core, len(classifier.color_names), connectivity)
+
+    stats[:, cv2.CC_STAT_LEFT] += x0
+    stats[:, cv2.CC_STAT_TOP] += y0
+    centroids = centroids + (x0, y0)
+
+    return {
+        'region': region,
+        'colors': colors,
+        'stats': stats,
+        'centroids': centroids,
+        'top': ids[0].copy(),
+        'bottom': ids[-1].copy(),
+        'left': ids[:, 0].copy(),
+        'right': ids[:, -1].copy(),
+    }
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def _seam_pairs(a, b, colors, connectivity):
+    """Pairs of touching component ids across a seam (a on one side, b on the other)"""
+    shifts = (-1, 0, 1) if connectivity == 8 else (0,)
+    pairs = []
+    for shift in shifts:
+        if shift < 0:
+            sa, sb = a[-shift:], b[:shift]
+        elif shift > 0:
+            sa, sb = a[:-shift], b[shift:]
+        else:
+            sa, sb = a, b
+        touching = (sa > 0) & (sb > 0)
+        sa, sb = sa[touching], sb[touching]
+        same_color = colors[sa] == colors[sb]
+        pairs.append(np.stack([sa[same_color], sb[same_color]], axis=1))
+    return np.unique(np.concatenate(pairs), axis=0)
+
+@instrumentation.instrumented('merge')
+def merge_tiles(tiles, color_names, min_area=100, connectivity=8):
+    """Join components that cross tile seams and count objects like count_objects()"""
+    tiles = sorted(tiles, key=lambda t: t['region'][:2])
+    rows = max(t['region'][0] for t in tiles) + 1
+    cols = max(t['region'][1] for t in tiles) + 1
+
+    # Global ids: 0 is background, each tile's components follow the previous tile's
+    base = 1
+    grid = {}
+    for tile in tiles:
+        n = len(tile['colors'])
+        for key in ('top', 'bottom', 'left', 'right'):
+            edge = tile[key]
+            tile[key] = np.where(edge > 0, edge + (base - 1), 0)
+        grid[tile['region'][:2]] = tile
+        base += n
+
+    colors = np.concatenate([np.zeros(1, dtype=np.uint8)] + [t['colors'] for t in tiles])
+    stats = np.concatenate([np.zeros((1, 5), dtype=np.int64)] + [t['stats'] for t in tiles])
+    centroids = np.concatenate([np.zeros((1, 2))] + [t['centroids'] for t in tiles])
+
+    # Seams are assembled across the whole image so diagonal tile corners are covered too
+    pairs = []
+    for row in range(rows - 1):
+        above = np.concatenate([grid[row, col]['bottom'] for col in range(cols)])
+        below = np.concatenate([grid[row + 1, col]['top'] for col in range(cols)])
+        pairs.append(_seam_pairs(above, below, colors, connectivity))
+    for col in range(cols - 1):
+        left = np.concatenate([grid[row, col]['right'] for row in range(rows)])
+        right = np.concatenate([grid[row, col + 1]['left'] for row in range(rows)])
+        pairs.append(_seam_pairs(left, right, colors, connectivity))
+
+    parent = np.arange(len(colors))
+    for a, b in (np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int64)):
+        ra, rb = _find(parent, a), _find(parent, b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+
+    # Flatten the remaining chains by pointer jumping
+    roots = parent
+    while True:
+        next_roots = roots[roots]
+        if np.array_equal(next_roots, roots):
+            break
+        roots = next_roots
+
+    # Aggregate merged components onto their roots
+    areas = stats[:, cv2.CC_STAT_AREA]
+    x0s = stats[:, cv2.CC_STAT_LEFT]
+    y0s = stats[:, cv2.CC_STAT_TOP]
+    x1s = x0s + stats[:, cv2.CC_STAT_WIDTH]
+    y1s = y0s + stats[:, cv2.CC_STAT_HEIGHT]
+
+    merged_area = np.bincount(roots, weights=areas, minlength=len(parent)).astype(np.int64)
+    merged_cx = np.bincount(roots, weights=centroids[:, 0] * areas, minlength=len(parent))
+    merged_cy = np.bincount(roots, weights=centroids[:, 1] * areas, minlength=len(parent))
+    merged_x0, merged_y0 = x0s.copy(), y0s.copy()
+    merged_x1, merged_y1 = x1s.copy(), y1s.copy()
+    np.minimum.at(merged_x0, roots, x0s)
+    np.minimum.at(merged_y0, roots, y0s)
+    np.maximum.at(merged_x1, roots, x1s)
+    np.maximum.at(merged_y1, roots, y1s)
+
+    is_root = (roots == np.arange(len(parent))) & (merged_area > min_area)
+    is_root[0] = False
+
+    results = {}
+    for label, color_name in enumerate(color_names, start=1):
+        keep = np.flatnonzero(is_root & (colors == label))
+        area = merged_area[keep]
+        results[color_name] = {
+            'count': len(keep),
+            'areas': area,
+            'centroids': np.column_stack([merged_cx[keep] / area, merged_cy[keep] / area]),
+            'boxes': np.column_stack([merged_x0[keep], merged_y0[keep],
+                                      merged_x1[keep] - merged_x0[keep], merged_y1[keep] - merged_y0[keep]]),
+        }
+    return results
+
+def count_objects_tiled(image, classifier=None, tile_size=2048, min_area=100, kernel_size=5,
+                        connectivity=8, workers=None, labels_out=None):
+    """Count colored objects tile by tile with peak memory bounded by the tile size
+
+    `image` can be any array supporting slicing, such as a np.memmap. Tiles are
+    processed in parallel on `workers` threads and the result matches
+    count_objects() on the full eroded label map. With `labels_out`, such as a
+    memory-mapped buffer from image_io.create_output(), each tile also writes its
+    part of that label map there, so the full map never has to fit in memory.
+    """
+    classifier = classifier if classifier is not None else HSVClassifier()
+    kernel = np.ones((kernel_size, kernel_size), np.uint8)
+    regions = list(iter_tiles(image.shape[0], image.shape[1], tile_size))
+    local = threading.local()
+
+    def run(region):
+        if not hasattr(local, 'buffers'):
+            local.buffers = SegmentationBuffers()
+        return segment_tile(image, region, classifier, kernel, connectivity, local.buffers, labels_out)
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        tiles = list(executor.map(run, regions))
+
+    return merge_tiles(tiles, classifier.color_names, min_area, connectivity)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Count colored objects in a very large image tile by tile")
+    parser.add_argument('image', help="Image file (.npy and raw files are memory-mapped)")
+    parser.add_argument('--tile-size', type=int, default=2048, help="Tile edge length in pixels")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="Worker threads (default: CPU count)")
+    parser.add_argument('--min-area', type=int, default=100, help="Minimum object area in pixels")
+    parser.add_argument('--kernel-size', type=int, default=5, help="Erosion kernel size")
+    parser.add_argument('--color-profile', help="Color ranges from this calibrated profile (name or .json file)")
+    parser.add_argument('--labels', help="Write the eroded label map to this memory-mapped .npy or raw file")
+    add_raw_arguments(parser)
+    parser.add_argument('--profile', help="Write per-stage timing spans to this JSONL file")
+    parser.add_argument('--profile-memory', action='store_true', help="Also record bytes allocated per stage")
+    args = parser.parse_args(argv)
+
+    profile = open(args.profile, 'w') if args.profile else None
+    recorder = instrumentation.enable(profile, args.profile_memory) if profile else None
+    try:
+        image = open_image(args.image, **raw_options(args))
+        labels_out = create_output(args.labels, image.shape[:2]) if args.labels else None
+        classifier = profile_classifier(args.color_profile) if args.color_profile else None
+        objects = count_objects_tiled(image, classifier, tile_size=args.tile_size, min_area=args.min_area,
+                                      kernel_size=args.kernel_size, workers=args.workers, labels_out=labels_out)
+        if labels_out is not None:
+            labels_out.flush()
+    finally:
+        if profile:
+            instrumentation.disable()
+            profile.close()
+
+    counts = {name: result['count'] for name, result in objects.items()}
+    print(json.dumps({'path': args.image, 'counts': counts, 'total': sum(counts.values())}))
+    if recorder is not None:
+        print(json.dumps(recorder.summary()), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+Per-stage timing, peak memory and correctness benchmarks for document dewarping
+
+Run from the repository root or this folder:
+
+    python document-dewarping/benchmarks/bench_dewarping.py --sizes 1400x1200 2800x2400 --repeat 5
+
+Exits with status 1 if lines are missed, fitted curves stray from the shape of
+the synthetic ground truth by more than a quarter of the bend amplitude or fit
+it no better than straight lines, the dewarped page is not straighter than the
+input, or a vectorized stage no longer matches its original loop implementation.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from dewarp_pipeline import (
+    dewarp_line, dewarp_page, extract_line_points, find_text_lines, fit_curve, fit_lines,
+    preprocess_image, sample_curves
+)
+from synthetic import make_warped_page
+
+# Largest accepted curve shape error, as a fraction of the bend amplitude
+MAX_CURVE_ERROR = 0.25
+
+def measure(fn, repeat):
+    """Median wall time over `repeat` runs and peak traced allocation of one extra run"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, float(np.median(times)), peak
+
+def reference_find_text_lines(binary_img, window=80, threshold=0.5):
+    """Original row-by-row peak search of find_text_lines(), kept as a regression reference"""
+    h_proj = np.sum(binary_img == 0, axis=1)
+    h_proj_smooth = gaussian_filter1d(h_proj, sigma=2)
+
+    peaks = []
+    min_peak_height = np.mean(h_proj_smooth) * threshold
+
+    for i in range(window, len(h_proj_smooth) - window):
+        if (h_proj_smooth[i] > h_proj_smooth[i-window:i].max() and
+            h_proj_smooth[i] > h_proj_smooth[i+1:i+window].max() and
+            h_proj_smooth[i] > min_peak_height):
+            if not peaks or abs(i - peaks[-1]) > window:
+                peaks.append(i)
+
+    return peaks
+
+def peaks_match_reference(binary_img):
+    """Whether find_text_lines() reproduces the original peak search for several windows and thresholds"""
+    return all(find_text_lines(binary_img, window, threshold) == reference_find_text_lines(binary_img, window, threshold)
+               for window in (2, 3, 20, 80, 81) for threshold in (0.0, 0.5, 1.5))
+
+def reference_extract_line_points(binary_img, center_y, window_height=50):
+    """Original per-strip loop of extract_line_points(), kept as a regression reference"""
+    height, width = binary_img.shape
+    points = []
+    window_width = 10
+    step = 2
+
+    for x in range(0, width - window_width, step):
+        y_start = max(0, center_y - window_height)
+        y_end = min(height, center_y + window_height)
+        strip = binary_img[y_start:y_end, x:x+window_width]
+
+        black_pixels = np.where(strip == 0)
+        if len(black_pixels[0]) > window_width:
+            y_positions = black_pixels[0]
+            weights = np.exp(-0.5 * ((y_positions - len(y_positions)/2) / (len(y_positions)/4))**2)
+            y = y_start + np.average(y_positions, weights=weights)
+            points.append((x + window_width//2, y))
+
+    return np.array(points).reshape(-1, 2)
+
+def noise_bands(height, width, seed):
+    """Binary image of random black speckle whose density varies from row band to row band"""
+    rng = np.random.default_rng(seed)
+    density = np.repeat(rng.uniform(0, 0.3, height // 20 + 1), 20)[:height, None]
+    return np.where(rng.random((height, width)) < density, 0, 255).astype(np.uint8)
+
+def matches_reference(binary_img, line_positions):
+    """Whether extract_line_points() reproduces the original loop on every line and both page edges"""
+    height = binary_img.shape[0]
+    for y_pos in list(line_positions) + [0, 10, height // 2, height - 1]:
+        expected = reference_extract_line_points(binary_img, y_pos)
+        actual = extract_line_points(binary_img, y_pos)
+        if expected.shape != actual.shape or not np.allclose(expected, actual, rtol=0, atol=1e-9):
+            return False
+    return True
+
+def line_spread(binary_img, line_positions):
+    """Mean standard deviation of the extracted rows along each line; 0 for straight lines"""
+    spreads = [extract_line_points(binary_img, y)[:, 1].std() for y in line_positions]
+    return float(np.mean(spreads)) if spreads else float('nan')
+
+def curve_error(samples, truth):
+    """Median row distance between each fitted curve and its nearest true line, after removing a constant offset per line
+
+    Synthetic strokes reach further above their true row than below it, so
+    fitted curves run a few rows high along their whole length. Only the shape
+    matters for straightening, so that offset is not counted.
+    """
+    if len(samples) == 0:
+        return float('inf')
+    nearest = np.argmin(np.abs(samples.mean(axis=1)[:, None] - truth.mean(axis=1)[None, :]), axis=1)
+    difference = samples - truth[nearest]
+    return float(np.median(np.abs(difference - np.median(difference, axis=1, keepdims=True))))
+
+def flat_error(truth):
+    """curve_error() of straight lines through each true line, the score of a fitter ignoring the bend"""
+    flat = np.repeat(truth.mean(axis=1, keepdims=True), truth.shape[1], axis=1)
+    return curve_error(flat, truth)
+
+def run(sizes, repeat, amplitude, seed):
+    rows = []
+
+    for height, width in sizes:
+        page, truth = make_warped_page(height, width, amplitude=amplitude, seed=seed)
+        binary = preprocess_image(page)
+        line_positions = find_text_lines(binary)
+        y_pos = line_positions[len(line_positions) // 2]
+        points = extract_line_points(binary, y_pos)
+        curve_func = fit_curve(points)
+
+        stages = [
+            ('preprocess', lambda: preprocess_image(page)),
+            ('find_lines', lambda: find_text_lines(binary)),
+            ('extract_points', lambda: extract_line_points(binary, y_pos)),
+            ('fit_curve', lambda: fit_curve(points)),
+            ('dewarp_line', lambda: dewarp_line(binary, curve_func, y_pos)),
+            ('fit_lines', lambda: fit_lines(binary, line_positions)),
+            ('dewarp_page', lambda: dewarp_page(binary, line_positions=line_positions, visualize=False)),
+        ]
+
+        results = {}
+        for name, fn in stages:
+            results[name], seconds, peak = measure(fn, repeat)
+            rows.append({
+                'stage': name,
+                'size': f"{height}x{width}",
+                'megapixels': height * width / 1e6,
+                'seconds': seconds,
+                'peak_bytes': peak,
+            })
+
+        samples = sample_curves(results['fit_lines'], height, width)
+        dewarped = results['dewarp_page'][0]
+        before = line_spread(binary, line_positions)
+        after = line_spread(dewarped, find_text_lines(dewarped))
+        error = curve_error(samples, truth)
+        baseline = flat_error(truth)
+        noise = noise_bands(height, width, seed)
+        rows.append({
+            'stage': 'equivalence',
+            'size': f"{height}x{width}",
+            'extract_points': (matches_reference(binary, line_positions) and
+                               matches_reference(noise, range(25, height, 150))),
+            'find_lines': peaks_match_reference(binary) and peaks_match_reference(noise),
+        })
+        rows[-1]['correct'] = all(v for k, v in rows[-1].items() if k not in ('stage', 'size'))
+
+        rows.append({
+            'stage': 'correctness',
+            'size': f"{height}x{width}",
+            'lines_found': len(line_positions),
+            'lines_expected': len(truth),
+            'curve_error': error,
+            'flat_error': baseline,
+            'spread_before': before,
+            'spread_after': after,
+            'correct': (len(line_positions) == len(truth) and error <= MAX_CURVE_ERROR * amplitude
+                        and (error < baseline or amplitude == 0) and after < before),
+        })
+
+    return rows
+
+def parse_size(text):
+    height, width = text.lower().split('x')
+    return int(height), int(width)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the dewarping stages on synthetic warped pages")
+    parser.add_argument('--sizes', type=parse_size, nargs='+', default=[(1400, 1200), (2800, 2400), (5600, 4800)],
+                        help="Page sizes as HEIGHTxWIDTH")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per stage")
+    parser.add_argument('--amplitude', type=float, default=4.0, help="Line bend amplitude in rows")
+    parser.add_argument('--seed', type=int, default=0, help="Page generator seed")
+    parser.add_argument('--json', help="Also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    rows = run(args.sizes, args.repeat, args.amplitude, args.seed)
+
+    print(f"{'stage':<15}{'size':>12}{'ms':>10}{'peak MB':>10}")
+    for row in rows:
+        if row['stage'] == 'equivalence':
+            checks = ", ".join(f"{k} {'yes' if v else 'NO'}" for k, v in row.items()
+                               if k not in ('stage', 'size', 'correct'))
+            print(f"{'equivalence':<15}{row['size']:>12}  matches original loops: {checks}")
+        elif row['stage'] == 'correctness':
+            print(f"{'correctness':<15}{row['size']:>12}  lines {row['lines_found']}/{row['lines_expected']}, "
+                  f"curve error {row['curve_error']:.2f} px (flat {row['flat_error']:.2f}), spread {row['spread_before']:.2f} -> "
+                  f"{row['spread_after']:.2f} px  {'yes' if row['correct'] else 'NO'}")
+        else:
+            print(f"{row['stage']:<15}{row['size']:>12}{row['seconds'] * 1000:>10.1f}{row['peak_bytes'] / 1e6:>10.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+    return 0 if all(row['correct'] for row in rows if row['stage'] in ('correctness', 'equivalence')) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
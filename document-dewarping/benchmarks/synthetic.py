@@ -0,0 +1,35 @@
+"""
+Deterministic synthetic warped pages with known text line curves
+"""
+
+import numpy as np
+
+def make_warped_page(height=1400, width=1200, n_lines=None, amplitude=15.0, spacing=160, seed=0):
+    """White page with dark glyph strokes along sinusoidally bent text lines
+
+    Lines start 150 rows from the top and are `spacing` rows apart, which keeps
+    neighbours further apart than find_text_lines()' 80 row window. Each line
+    bends by up to `amplitude` rows with its own phase, and every fifth 40 px
+    block is left blank as a word gap. Returns the grayscale page and the
+    (n_lines, width) array of true line rows at every column.
+    """
+    rng = np.random.default_rng(seed)
+    bases = np.arange(150, height - 150, spacing)
+    if n_lines is not None:
+        bases = bases[:n_lines]
+
+    page = np.full((height, width), 255, dtype=np.uint8)
+    x = np.arange(width)
+    truth = np.empty((len(bases), width))
+
+    for k, base in enumerate(bases):
+        truth[k] = base + amplitude * np.sin(x / width * 2 * np.pi + k * 0.3)
+
+        # Two pixel wide strokes, skipping word gaps and about a fifth at random
+        for x0 in range(0, width, 2):
+            if (x0 // 40) % 5 == 4 or rng.random() >= 0.8:
+                continue
+            center = int(truth[k, x0])
+            page[center - int(rng.integers(4, 12)):center + int(rng.integers(2, 6)), x0:x0 + 2] = 0
+
+    return page, truth
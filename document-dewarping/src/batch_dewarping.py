@@ -0,0 +1,288 @@
+"""
+Headless batch dewarping for directories, multi-page TIFFs and PDFs
+"""
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import cv2
+import numpy as np
+
+import instrumentation
+from dewarp_pipeline import dewarp_page, draw_line_curves, preprocess_image
+from image_io import MAPPED_EXTENSIONS, add_raw_arguments, create_output, is_mapped, open_image, raw_options
+from result_cache import ResultCache, process_page_cached
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff') + MAPPED_EXTENSIONS
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+def _init_worker(profile_memory=None):
+    # One OpenCV thread per process so the pool, not OpenCV, owns the cores
+    cv2.setNumThreads(1)
+    # Keep spans so they travel back to the parent's recorder with each record
+    if profile_memory is not None:
+        instrumentation.enable(memory=profile_memory, keep=True)
+
+def pdf_page_count(path):
+    try:
+        import pymupdf
+    except ImportError:
+        raise ImportError("PDF input requires PyMuPDF (pip install pymupdf)")
+    with pymupdf.open(path) as doc:
+        return doc.page_count
+
+def iter_pages(inputs):
+    """Yield a (path, page_index) descriptor for every page without loading any pixels"""
+    for item in inputs:
+        if os.path.isdir(item):
+            paths = [os.path.join(item, name) for name in sorted(os.listdir(item))
+                     if name.lower().endswith(IMAGE_EXTENSIONS + ('.pdf',))]
+        else:
+            paths = [item]
+
+        for path in paths:
+            lower = path.lower()
+            if lower.endswith('.pdf'):
+                count = pdf_page_count(path)
+            elif lower.endswith(TIFF_EXTENSIONS):
+                count = cv2.imcount(path, cv2.IMREAD_GRAYSCALE)
+            else:
+                count = 1
+            for index in range(count):
+                yield path, index
+
+def load_page(path, index, pdf_dpi=300, raw=None):
+    """Read one page as an 8-bit grayscale image
+
+    .npy and raw pages are memory-mapped rather than decoded; `raw` holds the
+    open_image() options describing raw dumps.
+    """
+    lower = path.lower()
+    if is_mapped(path):
+        page = open_image(path, cv2.IMREAD_GRAYSCALE, **(raw or {}))
+    elif lower.endswith('.pdf'):
+        import pymupdf
+        with pymupdf.open(path) as doc:
+            pixmap = doc[index].get_pixmap(dpi=pdf_dpi, colorspace=pymupdf.csGRAY)
+            samples = np.frombuffer(pixmap.samples, dtype=np.uint8)
+            page = samples.reshape(pixmap.height, pixmap.stride)[:, :pixmap.width].copy()
+    elif lower.endswith(TIFF_EXTENSIONS):
+        ok, pages = cv2.imreadmulti(path, index, 1, flags=cv2.IMREAD_GRAYSCALE)
+        page = pages[0] if ok and pages else None
+    else:
+        page = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+    if page is None:
+        raise ValueError(f"Failed to load page {index + 1} of {path}")
+    return page
+
+def page_name(path, index):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return f"{stem}_p{index + 1:04d}"
+
+def unique_name(name, used):
+    """`name`, or `name` with the lowest free counter suffix if it is already in `used`, which it is added to
+
+    page_name() always ends in a page number, so suffixed names never collide
+    with another page's plain name.
+    """
+    candidate, count = name, 1
+    while candidate in used:
+        count += 1
+        candidate = f"{name}_{count}"
+    used.add(candidate)
+    return candidate
+
+def process_page(path, index, output_dir=None, debug=False, warp_gray=False, pdf_dpi=300,
+                 cache_dir=None, cache_size=2 * 1024**3, page_format='png', raw=None, name=None):
+    """Load, binarize and dewarp one page in a worker process
+
+    With `output_dir` the page (and, with `debug`, its binary and line overlay)
+    is written there by the worker; otherwise the dewarped page is returned for
+    the caller to write. With `cache_dir` intermediate results are reused from
+    and stored in a ResultCache.
+
+    A `page_format` of 'npy' or 'raw' preallocates the output file as a memory
+    map and warps the page directly into it, so nothing is encoded or copied.
+    Output files are named after `name`, by default page_name().
+    """
+    with instrumentation.span('decode', path=path, page=index):
+        original = load_page(path, index, pdf_dpi, raw)
+    image = original if warp_gray else None
+
+    name = name or page_name(path, index)
+    out = None
+    if output_dir is not None and page_format != 'png':
+        out = create_output(os.path.join(output_dir, f"{name}.{page_format}"), original.shape)
+
+    if cache_dir is not None:
+        cache = ResultCache(cache_dir, cache_size)
+        binary, _, samples, dewarped = process_page_cached(original, cache, image=image, out=out)
+        lines_viz = draw_line_curves(binary, samples) if debug else None
+    else:
+        binary = preprocess_image(original)
+        dewarped, lines_viz = dewarp_page(binary, image=image, visualize=debug, out=out)
+
+    record = {'path': path, 'page': index, 'height': dewarped.shape[0], 'width': dewarped.shape[1]}
+    if output_dir is None:
+        record['image'] = dewarped
+    else:
+        if out is not None:
+            out.flush()
+        else:
+            with instrumentation.span('encode', dewarped):
+                cv2.imwrite(os.path.join(output_dir, f"{name}.png"), dewarped)
+        if debug:
+            cv2.imwrite(os.path.join(output_dir, f"{name}_binary.png"), binary)
+            cv2.imwrite(os.path.join(output_dir, f"{name}_lines.png"), lines_viz)
+
+    recorder = instrumentation.active()
+    if recorder is not None:
+        record['spans'] = recorder.drain()
+    return record
+
+class TiffPageWriter:
+    """Append pages to a multi-page TIFF one at a time"""
+
+    def __init__(self, path):
+        try:
+            import tifffile
+        except ImportError:
+            raise ImportError("Multi-page TIFF output requires tifffile (pip install tifffile)")
+        self.writer = tifffile.TiffWriter(path, bigtiff=True)
+
+    def write(self, page):
+        self.writer.write(page, photometric='minisblack', compression='zlib')
+
+    def close(self):
+        self.writer.close()
+
+def run_batch(pages, output, workers=None, debug=False, warp_gray=False, pdf_dpi=300, max_in_flight=None,
+              cache_dir=None, cache_size=2 * 1024**3, page_format='png', raw=None, verbose=False):
+    """Dewarp pages across a process pool, writing each result as soon as possible
+
+    `output` is a directory or a .tif/.tiff file. TIFF pages are written in input
+    order. At most `max_in_flight` pages (default twice the workers) are being
+    processed or waiting to be written, so memory stays bounded for any book
+    length. Failed pages are reported and skipped. Returns the number of failures.
+    Directory output is written as `page_format` ('png', 'npy' or 'raw') files.
+    With `verbose` every finished page is reported on stderr.
+
+    While instrumentation is enabled the workers record spans too, and they are
+    merged into this process's recorder as their pages finish.
+    """
+    workers = workers or os.cpu_count() or 1
+    recorder = instrumentation.active()
+    max_in_flight = max_in_flight or workers * 2
+    to_tiff = output.lower().endswith(TIFF_EXTENSIONS)
+
+    if to_tiff:
+        writer = TiffPageWriter(output)
+        output_dir = None
+        if debug:
+            print("Debug images are only written for directory output", file=sys.stderr)
+            debug = False
+    else:
+        writer = None
+        output_dir = output
+        os.makedirs(output_dir, exist_ok=True)
+
+    pages = iter(enumerate(pages))
+    used_names = set()
+    in_flight = {}
+    finished = {}
+    next_index = 0
+    failures = 0
+    exhausted = False
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(recorder.memory if recorder else None,)) as pool:
+            while True:
+                while not exhausted and len(in_flight) + len(finished) < max_in_flight:
+                    try:
+                        order, (path, index) = next(pages)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    # Pages of same-named inputs, e.g. a/scan.png and b/scan.png, get counter suffixes
+                    name = unique_name(page_name(path, index), used_names)
+                    if output_dir is not None and name != page_name(path, index):
+                        print(f"Writing {path} page {index + 1} as {name} to avoid overwriting", file=sys.stderr)
+                    future = pool.submit(process_page, path, index, output_dir, debug, warp_gray, pdf_dpi,
+                                         cache_dir, cache_size, page_format, raw, name)
+                    in_flight[future] = (order, path, index)
+
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    order, path, index = in_flight.pop(future)
+                    try:
+                        record = future.result()
+                        spans = record.pop('spans', None)
+                        if spans and recorder is not None:
+                            recorder.merge(spans)
+                        if verbose:
+                            print(f"Dewarped {path} page {index + 1}", file=sys.stderr)
+                    except Exception as e:
+                        failures += 1
+                        record = None
+                        print(f"Error processing {path} page {index + 1}: {str(e)}", file=sys.stderr)
+                    finished[order] = record
+
+                # Flush completed pages in input order
+                while next_index in finished:
+                    record = finished.pop(next_index)
+                    if writer is not None and record is not None:
+                        with instrumentation.span('encode', record['image']):
+                            writer.write(record['image'])
+                    next_index += 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dewarp scanned pages without the GUI")
+    parser.add_argument('inputs', nargs='+', help="Image files, multi-page TIFFs, PDFs or directories")
+    parser.add_argument('-o', '--output', required=True, help="Output directory or multi-page .tif file")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--debug', action='store_true', help="Also write binary and detected-line images")
+    parser.add_argument('--gray', action='store_true', dest='warp_gray',
+                        help="Warp the grayscale page with bilinear sampling instead of the binary")
+    parser.add_argument('--dpi', type=int, default=300, dest='pdf_dpi', help="Rasterization DPI for PDF input")
+    parser.add_argument('--page-format', choices=['png', 'npy', 'raw'], default='png',
+                        help="Page format for directory output; npy and raw are memory-mapped, not encoded")
+    add_raw_arguments(parser)
+    parser.add_argument('-v', '--verbose', action='store_true', help="Report every finished page on stderr")
+    parser.add_argument('--cache-dir', default=None, help="Reuse binarization, line and curve results from this cache")
+    parser.add_argument('--cache-size', type=float, default=2.0, help="Maximum cache size in GB")
+    parser.add_argument('--profile', help="Write per-stage timing spans to this JSONL file")
+    parser.add_argument('--profile-memory', action='store_true', help="Also record bytes allocated per stage")
+    args = parser.parse_args(argv)
+
+    profile = open(args.profile, 'w') if args.profile else None
+    recorder = instrumentation.enable(profile, args.profile_memory) if profile else None
+    try:
+        failures = run_batch(iter_pages(args.inputs), args.output, workers=args.workers, debug=args.debug,
+                             warp_gray=args.warp_gray, pdf_dpi=args.pdf_dpi, cache_dir=args.cache_dir,
+                             cache_size=int(args.cache_size * 1024**3), page_format=args.page_format,
+                             raw=raw_options(args), verbose=args.verbose)
+    finally:
+        if profile:
+            instrumentation.disable()
+            profile.close()
+
+    print(f"Finished with {failures} failed pages", file=sys.stderr)
+    if recorder is not None:
+        print(json.dumps(recorder.summary()), file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
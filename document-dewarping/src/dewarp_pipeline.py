@@ -0,0 +1,409 @@
+"""
+Dewarping pipeline: binarization, line detection, curve fitting and page warping
+
+Has no GUI dependencies, so the batch tool, the result cache and the
+benchmarks can use it without tkinter or customtkinter installed.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from scipy.interpolate import interp1d
+from scipy.ndimage import gaussian_filter1d, maximum_filter1d
+
+from image_io import open_image
+from instrumentation import instrumented
+
+@instrumented('binarization')
+def preprocess_image(img, clip_limit=2.0, tile_grid_size=(8,8)):
+    """Enhance image quality and convert to binary"""
+    clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
+    enhanced = clahe.apply(img)
+    # Threshold in place so only one page-sized array is allocated
+    _, binary = cv2.threshold(enhanced, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=enhanced)
+    return binary
+
+@instrumented('line_detection')
+def find_text_lines(binary_img, window=80, threshold=0.5):
+    """Find text lines with improved peak detection
+
+    A row is a peak when its smoothed black-pixel count is above
+    `threshold` times the mean and strictly above every row within `window`
+    rows on either side; peaks closer than `window` to the previous one are dropped.
+    """
+    h_proj = np.sum(binary_img == 0, axis=1)
+    h_proj_smooth = gaussian_filter1d(h_proj, sigma=2)
+    n = len(h_proj_smooth)
+    if n < 2 * window + 1:
+        return []
+
+    min_peak_height = np.mean(h_proj_smooth) * threshold  # Adaptive threshold
+
+    # window_max[j] = max(h[j:j + window]), right_max[j] = max(h[j:j + window - 1])
+    window_max = maximum_filter1d(h_proj_smooth, size=window, origin=-(window // 2))
+    right_max = maximum_filter1d(h_proj_smooth, size=max(1, window - 1), origin=-((window - 1) // 2))
+
+    i = np.arange(window, n - window)
+    candidates = i[(h_proj_smooth[i] > window_max[i - window]) &
+                   (h_proj_smooth[i] > right_max[i + 1]) &
+                   (h_proj_smooth[i] > min_peak_height)]
+
+    peaks = []
+    for i in candidates:
+        if not peaks or abs(i - peaks[-1]) > window:
+            peaks.append(int(i))
+
+    return peaks
+
+def extract_line_points(binary_img, center_y, window_height=50):
+    """Extract points along a text line"""
+    height, width = binary_img.shape
+    window_width = 10
+    step = 2
+
+    y_start = max(0, center_y - window_height)
+    y_end = min(height, center_y + window_height)
+    band = binary_img[y_start:y_end]
+
+    # Black pixels per row in every strip [x, x + window_width), from a running column sum
+    xs = np.arange(0, width - window_width, step)
+    black_cumsum = np.zeros((band.shape[0], width + 1), dtype=np.int32)
+    np.cumsum(band == 0, axis=1, out=black_cumsum[:, 1:])
+    counts = black_cumsum[:, xs + window_width] - black_cumsum[:, xs]
+
+    totals = counts.sum(axis=0)
+    valid = totals > window_width
+    xs, counts, totals = xs[valid], counts[:, valid], totals[valid]
+
+    # Gaussian weight per black pixel, centred on half the strip's black pixel count
+    rows = np.arange(band.shape[0])[:, None]
+    weights = counts * np.exp(-0.5 * ((rows - totals / 2) / (totals / 4))**2)
+    weight_sums = weights.sum(axis=0)
+    valid = weight_sums > 0
+
+    y = y_start + (weights * rows).sum(axis=0)[valid] / weight_sums[valid]
+    return np.column_stack((xs[valid] + window_width//2, y))
+
+def fit_curve(points):
+    """Fit smooth curve through points"""
+    if len(points) < 4:
+        return None
+    
+    try:
+        points = points[points[:, 0].argsort()]
+        window = 5
+        y_median = np.median(points[max(0, len(points)-window):len(points), 1])
+        mask = np.abs(points[:, 1] - y_median) < 50
+        points = points[mask]
+        
+        if len(points) < 4:
+            return None
+        
+        f = interp1d(points[:, 0], points[:, 1], 
+                    kind='cubic',
+                    fill_value='extrapolate')
+        
+        y_pred = f(points[:, 0])
+        if np.any(np.abs(y_pred - points[:, 1]) > 100):
+            return None
+            
+        return f
+    except:
+        return None
+
+def smooth_curve(curve_func, height, width, window_height=50, sigma=2.0):
+    """Sample a fitted curve at every column, clipped to the page and smoothed"""
+    y_coords = curve_func(np.arange(width))
+    y_coords = np.clip(y_coords, window_height, height - window_height)
+    return gaussian_filter1d(y_coords, sigma=sigma)
+
+def dewarp_line(binary_img, curve_func, center_y, window_height=50):
+    """Dewarp a single text line"""
+    height, width = binary_img.shape
+    dewarped = np.full((2 * window_height, width), 255, dtype=np.uint8)
+
+    try:
+        y_coords = smooth_curve(curve_func, height, width, window_height)
+
+        # Row j of the output samples src_y - window_height + j in every column
+        offsets = np.arange(-window_height, window_height, dtype=np.float32)
+        map_y = np.floor(y_coords).astype(np.float32)[None, :] + offsets[:, None]
+        map_x = np.broadcast_to(np.arange(width, dtype=np.float32), map_y.shape).copy()
+        cv2.remap(binary_img, map_x, map_y, cv2.INTER_NEAREST, dst=dewarped,
+                  borderMode=cv2.BORDER_CONSTANT, borderValue=255)
+
+    except Exception as e:
+        print(f"Error in dewarping: {str(e)}")
+
+    return dewarped
+
+def sample_curves(curves, height, width, window_height=50, sigma=2.0):
+    """Smoothed row of every fitted line at every column, as an (n_lines, width) array"""
+    samples = [smooth_curve(curve_func, height, width, window_height, sigma) for curve_func in curves]
+    return np.array(samples).reshape(len(samples), width)
+
+def build_displacement(samples):
+    """Straight target row and per-column vertical displacement of every text line
+
+    Each line is straightened onto its mean row. Returns the target rows in
+    ascending order and an (n_lines, width) array of source-minus-target offsets.
+    """
+    targets = samples.mean(axis=1)
+    order = np.argsort(targets)
+    targets = targets[order]
+    displacement = samples[order] - targets[:, None]
+    return targets, displacement.astype(np.float32)
+
+@instrumented('warping')
+def warp_page(image, targets, displacement, interpolation=cv2.INTER_NEAREST, chunk_rows=512, out=None):
+    """Warp the whole page with cv2.remap, interpolating displacement between lines
+
+    Rows between two text lines take a linear blend of both lines' offsets and
+    rows above the first or below the last line keep that line's offset. The
+    map is built and applied in bands of `chunk_rows` rows to bound memory.
+    Each band is written straight into `out` when given, e.g. a buffer from
+    image_io.create_output(), and otherwise into a new array.
+    """
+    height, width = image.shape[:2]
+    result = np.empty_like(image) if out is None else out
+    map_x = np.empty((chunk_rows, width), dtype=np.float32)
+    map_x[:] = np.arange(width, dtype=np.float32)
+
+    for y0 in range(0, height, chunk_rows):
+        y1 = min(height, y0 + chunk_rows)
+        rows = np.arange(y0, y1, dtype=np.float32)
+
+        if len(targets) == 1:
+            map_y = displacement[0][None, :] + rows[:, None]
+        else:
+            upper = np.clip(np.searchsorted(targets, rows), 1, len(targets) - 1)
+            lower = upper - 1
+            span = targets[upper] - targets[lower]
+            alpha = np.clip((rows - targets[lower]) / np.where(span > 0, span, 1), 0, 1).astype(np.float32)
+            map_y = displacement[lower] * (1 - alpha)[:, None]
+            map_y += displacement[upper] * alpha[:, None]
+            map_y += rows[:, None]
+
+        cv2.remap(image, map_x[:y1 - y0], map_y, interpolation, dst=result[y0:y1],
+                  borderMode=cv2.BORDER_REPLICATE)
+
+    return result
+
+class ProcessingCancelled(Exception):
+    """Raised when processing is stopped through its cancel event"""
+
+def check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise ProcessingCancelled()
+
+def fit_line(binary_img, y_pos, window_height=50):
+    """Fit the curve of the text line at y_pos, or None if it cannot be fitted"""
+    points = extract_line_points(binary_img, y_pos, window_height)
+    if len(points) < 4:
+        return None
+    return fit_curve(points)
+
+@instrumented('curve_fitting')
+def fit_lines(binary_img, line_positions, window_height=50, executor=None, workers=None,
+              progress=None, cancel_event=None):
+    """Fit every detected line, dropping the ones that cannot be fitted
+
+    Lines are fitted concurrently on `executor`, or on a temporary pool of
+    `workers` threads, and kept in line order. `progress(done, total)` is called
+    after each line, possibly from a worker thread.
+    """
+    total = len(line_positions)
+    completed = [0]
+    lock = threading.Lock()
+
+    def fit(y_pos):
+        check_cancelled(cancel_event)
+        curve_func = fit_line(binary_img, y_pos, window_height)
+        if progress is not None:
+            with lock:
+                completed[0] += 1
+                done = completed[0]
+            progress(done, total)
+        return curve_func
+
+    if executor is not None:
+        fitted = list(executor.map(fit, line_positions))
+    elif workers is not None and workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            fitted = list(pool.map(fit, line_positions))
+    else:
+        fitted = [fit(y_pos) for y_pos in line_positions]
+    return [curve_func for curve_func in fitted if curve_func is not None]
+
+def draw_line_curves(binary_img, samples):
+    """Overlay the sampled line curves on the binary image for debugging"""
+    line_viz = cv2.cvtColor(binary_img, cv2.COLOR_GRAY2BGR)
+    x_coords = np.arange(0, binary_img.shape[1], 5)
+    for y_coords in samples:
+        points = np.column_stack((x_coords, y_coords[x_coords])).astype(np.int32)
+        cv2.polylines(line_viz, [points], False, (0, 255, 0), 2)
+    return line_viz
+
+def warp_from_samples(source, samples, interpolation=cv2.INTER_NEAREST, out=None):
+    """Dewarp a page from its sampled line curves, or copy it if there are none"""
+    if len(samples) == 0:
+        if out is None:
+            return source.copy()
+        out[...] = source
+        return out
+    targets, displacement = build_displacement(samples)
+    return warp_page(source, targets, displacement, interpolation, out=out)
+
+def dewarp_page(binary_img, image=None, interpolation=None, executor=None, workers=None, visualize=True,
+                progress=None, cancel_event=None, line_positions=None, window_height=50, sigma=2.0, out=None):
+    """Dewarp entire page
+
+    The page is warped in one remap pass built from all fitted line curves.
+    Pass the grayscale `image` to warp it instead of the binary, by default with
+    bilinear sampling. Lines are fitted by fit_lines() on `executor` or
+    `workers` threads; `line_positions` skips line detection when already known.
+    With `visualize=False` no debug overlay is drawn and None is returned in its place.
+    The dewarped page is written into `out` when given.
+
+    `progress(done, total)` is called after each line is fitted. Setting
+    `cancel_event` makes the remaining work raise ProcessingCancelled.
+    """
+    if line_positions is None:
+        line_positions = find_text_lines(binary_img)
+    height, width = binary_img.shape
+
+    curves = fit_lines(binary_img, line_positions, window_height, executor, workers, progress, cancel_event)
+    samples = sample_curves(curves, height, width, window_height, sigma)
+
+    check_cancelled(cancel_event)
+    line_viz = draw_line_curves(binary_img, samples) if visualize else None
+
+    source = binary_img if image is None else image
+    if interpolation is None:
+        interpolation = cv2.INTER_NEAREST if image is None else cv2.INTER_LINEAR
+
+    return warp_from_samples(source, samples, interpolation, out), line_viz
+
+class PagePipeline:
+    """Lazily evaluated, memoized stages of the dewarping pipeline for one page
+
+    Each stage is computed on first request from the stages and parameters it
+    depends on. set() invalidates only the stages downstream of the changed
+    parameters, so e.g. a new smoothing sigma re-samples the curves and re-warps
+    without reloading, re-binarizing or re-detecting lines.
+    """
+
+    # stage: (upstream stages, parameters)
+    STAGES = {
+        'original': ((), ('image_path',)),
+        'binary': (('original',), ('clip_limit', 'tile_grid_size')),
+        'line_positions': (('binary',), ('peak_window', 'peak_threshold')),
+        'points': (('binary', 'line_positions'), ('window_height',)),
+        'curves': (('points',), ()),
+        'samples': (('binary', 'curves'), ('window_height', 'sigma')),
+        'line_viz': (('binary', 'samples'), ()),
+        'dewarped': (('binary', 'samples'), ()),
+    }
+
+    DEFAULTS = {
+        'image_path': None,
+        'clip_limit': 2.0,
+        'tile_grid_size': (8, 8),
+        'peak_window': 80,
+        'peak_threshold': 0.5,
+        'window_height': 50,
+        'sigma': 2.0,
+    }
+
+    def __init__(self, image_path=None, **params):
+        self.params = dict(self.DEFAULTS)
+        self.params.update(params, image_path=image_path)
+        self._values = {}
+
+    def set(self, **params):
+        """Change parameters, dropping every stage that depends on a changed one"""
+        for name, value in params.items():
+            if name not in self.params:
+                raise KeyError(f"Unknown parameter: {name}")
+            if self.params[name] == value:
+                continue
+            self.params[name] = value
+            for stage, (_, stage_params) in self.STAGES.items():
+                if name in stage_params:
+                    self.invalidate(stage)
+
+    def invalidate(self, stage):
+        """Drop a stage and everything downstream of it"""
+        self._values.pop(stage, None)
+        for other, (upstream, _) in self.STAGES.items():
+            if stage in upstream and other in self._values:
+                self.invalidate(other)
+
+    def is_cached(self, stage):
+        return stage in self._values
+
+    def get(self, stage, progress=None, cancel_event=None):
+        """Return a stage's value, computing it and any missing upstream stages"""
+        if stage not in self._values:
+            for upstream in self.STAGES[stage][0]:
+                self.get(upstream, progress, cancel_event)
+            check_cancelled(cancel_event)
+            self._values[stage] = getattr(self, f"_compute_{stage}")(progress, cancel_event)
+        return self._values[stage]
+
+    def _compute_original(self, progress, cancel_event):
+        return open_image(self.params['image_path'], cv2.IMREAD_GRAYSCALE)
+
+    def _compute_binary(self, progress, cancel_event):
+        return preprocess_image(self._values['original'], self.params['clip_limit'], self.params['tile_grid_size'])
+
+    def _compute_line_positions(self, progress, cancel_event):
+        return find_text_lines(self._values['binary'], self.params['peak_window'], self.params['peak_threshold'])
+
+    def _compute_points(self, progress, cancel_event):
+        binary = self._values['binary']
+        line_positions = self._values['line_positions']
+        points = []
+        for done, y_pos in enumerate(line_positions, start=1):
+            check_cancelled(cancel_event)
+            points.append(extract_line_points(binary, y_pos, self.params['window_height']))
+            if progress is not None:
+                progress(done, len(line_positions))
+        return points
+
+    def _compute_curves(self, progress, cancel_event):
+        curves = [fit_curve(points) if len(points) >= 4 else None for points in self._values['points']]
+        return [curve_func for curve_func in curves if curve_func is not None]
+
+    def _compute_samples(self, progress, cancel_event):
+        height, width = self._values['binary'].shape
+        return sample_curves(self._values['curves'], height, width, self.params['window_height'], self.params['sigma'])
+
+    def _compute_line_viz(self, progress, cancel_event):
+        return draw_line_curves(self._values['binary'], self._values['samples'])
+
+    def _compute_dewarped(self, progress, cancel_event):
+        return warp_from_samples(self._values['binary'], self._values['samples'])
+
+    def debug_images(self, progress=None, cancel_event=None):
+        return {
+            '1. Original': self.get('original', progress, cancel_event),
+            '2. Binary': self.get('binary', progress, cancel_event),
+            '3. Detected Lines': self.get('line_viz', progress, cancel_event),
+            '4. Final Dewarped': self.get('dewarped', progress, cancel_event)
+        }
+
+def process_page_with_debug(image_path, progress=None, cancel_event=None):
+    """Process page and show intermediate results
+
+    Raises ProcessingCancelled if `cancel_event` is set while running.
+    """
+    try:
+        return PagePipeline(image_path).debug_images(progress, cancel_event)
+    except ProcessingCancelled:
+        raise
+    except Exception as e:
+        print(f"Error processing page: {str(e)}")
+        return None
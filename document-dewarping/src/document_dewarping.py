@@ -6,178 +6,27 @@ import tkinter as tk
 from tkinter import filedialog, ttk
 import cv2
 import numpy as np
-from scipy.interpolate import interp1d
-from scipy.ndimage import gaussian_filter1d
 from PIL import Image, ImageTk
 import customtkinter as ctk
 import os
+import queue
+import threading
 
-def preprocess_image(img):
-    """Enhance image quality and convert to binary"""
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-    enhanced = clahe.apply(img)
-    _, binary = cv2.threshold(enhanced, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    return binary
-
-def find_text_lines(binary_img):
-    """Find text lines with improved peak detection"""
-    h_proj = np.sum(binary_img == 0, axis=1)
-    h_proj_smooth = gaussian_filter1d(h_proj, sigma=2)
-    
-    peaks = []
-    window = 80  # Adjusted window size
-    min_peak_height = np.mean(h_proj_smooth) * 0.5  # Adaptive threshold
-    
-    for i in range(window, len(h_proj_smooth) - window):
-        if (h_proj_smooth[i] > h_proj_smooth[i-window:i].max() and
-            h_proj_smooth[i] > h_proj_smooth[i+1:i+window].max() and
-            h_proj_smooth[i] > min_peak_height):
-            if not peaks or abs(i - peaks[-1]) > window:
-                peaks.append(i)
-    
-    return peaks
-
-def extract_line_points(binary_img, center_y, window_height=50):
-    """Extract points along a text line"""
-    height, width = binary_img.shape
-    points = []
-    window_width = 10
-    step = 2
-    
-    for x in range(0, width - window_width, step):
-        y_start = max(0, center_y - window_height)
-        y_end = min(height, center_y + window_height)
-        strip = binary_img[y_start:y_end, x:x+window_width]
-        
-        black_pixels = np.where(strip == 0)
-        if len(black_pixels[0]) > window_width:
-            y_positions = black_pixels[0]
-            weights = np.exp(-0.5 * ((y_positions - len(y_positions)/2) / (len(y_positions)/4))**2)
-            y = y_start + np.average(y_positions, weights=weights)
-            points.append((x + window_width//2, y))
-    
-    return np.array(points)
+from dewarp_pipeline import PagePipeline, ProcessingCancelled
+from image_io import open_image
 
-def fit_curve(points):
-    """Fit smooth curve through points"""
-    if len(points) < 4:
-        return None
+def build_pyramid(img, min_size=256):
+    """Convert an image for display once and build successively half-sized levels"""
+    if len(img.shape) == 2:
+        base = img
+    else:
+        base = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
     
-    try:
-        points = points[points[:, 0].argsort()]
-        window = 5
-        y_median = np.median(points[max(0, len(points)-window):len(points), 1])
-        mask = np.abs(points[:, 1] - y_median) < 50
-        points = points[mask]
-        
-        if len(points) < 4:
-            return None
-        
-        f = interp1d(points[:, 0], points[:, 1], 
-                    kind='cubic',
-                    fill_value='extrapolate')
-        
-        y_pred = f(points[:, 0])
-        if np.any(np.abs(y_pred - points[:, 1]) > 100):
-            return None
-            
-        return f
-    except:
-        return None
-
-def dewarp_line(binary_img, curve_func, center_y, window_height=50):
-    """Dewarp a single text line"""
-    height, width = binary_img.shape
-    dewarped = np.ones((2 * window_height, width), dtype=np.uint8) * 255
-    
-    x_coords = np.arange(width)
-    try:
-        y_coords = curve_func(x_coords)
-        y_coords = np.clip(y_coords, window_height, height - window_height)
-        y_coords = gaussian_filter1d(y_coords, sigma=2.0)
-        
-        for x, src_y in zip(x_coords, y_coords):
-            src_y = int(src_y)
-            local_window = window_height
-            y_start = max(0, src_y - local_window)
-            y_end = min(height, src_y + local_window)
-            strip = binary_img[y_start:y_end, x]
-            dst_start = max(0, min(2 * window_height, window_height - (src_y - y_start)))
-            dst_end = min(2 * window_height, dst_start + (y_end - y_start))
-            if len(strip) > 0:
-                dewarped[dst_start:dst_end, x] = strip[:dst_end-dst_start]
-                
-    except Exception as e:
-        print(f"Error in dewarping: {str(e)}")
-    
-    return dewarped
-
-def dewarp_page(binary_img):
-    """Dewarp entire page"""
-    line_positions = find_text_lines(binary_img)
-    dewarped_lines = []
-    line_viz = cv2.cvtColor(binary_img.copy(), cv2.COLOR_GRAY2BGR)
-    padding = 20
-    
-    for y_pos in line_positions:
-        points = extract_line_points(binary_img, y_pos)
-        if len(points) < 4:
-            continue
-            
-        curve_func = fit_curve(points)
-        if curve_func is None:
-            continue
-            
-        x_coords = np.arange(0, binary_img.shape[1], 5)
-        y_coords = curve_func(x_coords)
-        points = np.column_stack((x_coords, y_coords)).astype(np.int32)
-        cv2.polylines(line_viz, [points], False, (0, 255, 0), 2)
-        
-        dewarped_line = dewarp_line(binary_img, curve_func, y_pos)
-        padded_line = np.ones((dewarped_line.shape[0] + padding, dewarped_line.shape[1]), dtype=np.uint8) * 255
-        padded_line[:-padding] = dewarped_line
-        dewarped_lines.append(padded_line)
-    
-    if dewarped_lines:
-        total_height = sum(line.shape[0] for line in dewarped_lines)
-        result = np.ones((total_height, binary_img.shape[1]), dtype=np.uint8) * 255
-        
-        y_offset = 0
-        for line in dewarped_lines:
-            h = line.shape[0]
-            result[y_offset:y_offset+h] = line
-            y_offset += h
-            
-        return result, line_viz
-    
-    return binary_img.copy(), line_viz
-
-def process_page_with_debug(image_path):
-    """Process page and show intermediate results"""
-    try:
-        # Read image
-        original = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-        if original is None:
-            raise ValueError(f"Failed to load image: {image_path}")
-        
-        # Preprocess
-        binary = preprocess_image(original)
-        
-        # Dewarp
-        dewarped, lines_viz = dewarp_page(binary)
-        
-        # Create debug images
-        debug_images = {
-            '1. Original': original,
-            '2. Binary': binary,
-            '3. Detected Lines': lines_viz,
-            '4. Final Dewarped': dewarped
-        }
-        
-        return debug_images
-    except Exception as e:
-        print(f"Error processing page: {str(e)}")
-        return None
+    levels = [base]
+    while min(levels[-1].shape[:2]) > min_size:
+        height, width = levels[-1].shape[:2]
+        levels.append(cv2.resize(levels[-1], ((width + 1) // 2, (height + 1) // 2), interpolation=cv2.INTER_AREA))
+    return levels
 
 class ImageDisplay(ttk.Frame):
     def __init__(self, parent, title):
@@ -189,8 +38,8 @@ class ImageDisplay(ttk.Frame):
         
         # Create canvas with scrollbars
         self.canvas = tk.Canvas(self.frame, bd=0, highlightthickness=0)
-        self.h_scroll = ttk.Scrollbar(self.frame, orient="horizontal", command=self.canvas.xview)
-        self.v_scroll = ttk.Scrollbar(self.frame, orient="vertical", command=self.canvas.yview)
+        self.h_scroll = ttk.Scrollbar(self.frame, orient="horizontal", command=self._xview)
+        self.v_scroll = ttk.Scrollbar(self.frame, orient="vertical", command=self._yview)
         
         # Configure canvas scrolling
         self.canvas.configure(xscrollcommand=self.h_scroll.set, yscrollcommand=self.v_scroll.set)
@@ -204,52 +53,160 @@ class ImageDisplay(ttk.Frame):
         self.frame.grid_rowconfigure(0, weight=1)
         self.frame.grid_columnconfigure(0, weight=1)
         
-        # Bind mouse wheel
+        # Bind mouse wheel (scroll), Ctrl + wheel (zoom), drag (pan) and resize
         self.canvas.bind("<MouseWheel>", self._on_mousewheel)
+        self.canvas.bind("<Control-MouseWheel>", self._on_zoom)
+        self.canvas.bind("<Button-4>", self._on_mousewheel)
+        self.canvas.bind("<Button-5>", self._on_mousewheel)
+        self.canvas.bind("<Control-Button-4>", self._on_zoom)
+        self.canvas.bind("<Control-Button-5>", self._on_zoom)
+        self.canvas.bind("<ButtonPress-1>", lambda event: self.canvas.scan_mark(event.x, event.y))
+        self.canvas.bind("<B1-Motion>", self._on_drag)
+        self.canvas.bind("<Configure>", lambda event: self._update_view())
         
         # Initialize variables
         self.image = None
+        self.pyramid = []
         self.photo = None
         self.display_size = (400, 400)
         self.zoom = 1.0
+        self.min_zoom = 1.0
+        self.max_zoom = 32.0
+        self._render_pending = False
+
+    def _viewport_size(self):
+        width, height = self.canvas.winfo_width(), self.canvas.winfo_height()
+        if width <= 1 or height <= 1:
+            return self.display_size
+        return width, height
+
+    def _scale(self):
+        """Display pixels per full-resolution pixel: fit to the viewport, then zoom"""
+        height, width = self.pyramid[0].shape[:2]
+        view_width, view_height = self._viewport_size()
+        return min(view_width / width, view_height / height, 1.0) * self.zoom
+
+    def _xview(self, *args):
+        self.canvas.xview(*args)
+        self._schedule_render()
+
+    def _yview(self, *args):
+        self.canvas.yview(*args)
+        self._schedule_render()
 
     def _on_mousewheel(self, event):
-        self.canvas.yview_scroll(-1 * (event.delta // 120), "units")
+        if event.num == 4:
+            steps = -1
+        elif event.num == 5:
+            steps = 1
+        else:
+            steps = -1 * (event.delta // 120)
+        self.canvas.yview_scroll(steps, "units")
+        self._schedule_render()
 
-    def display_image(self, img):
-        if img is None:
+    def _on_drag(self, event):
+        self.canvas.scan_dragto(event.x, event.y, gain=1)
+        self._schedule_render()
+
+    def _on_zoom(self, event):
+        if not self.pyramid:
+            return
+        zoom_in = event.num == 4 or getattr(event, 'delta', 0) > 0
+        self.set_zoom(self.zoom * (1.25 if zoom_in else 0.8), event.x, event.y)
+
+    def set_zoom(self, zoom, anchor_x=0, anchor_y=0):
+        """Zoom relative to fit-to-window, keeping the point under the anchor fixed"""
+        if not self.pyramid:
+            return
+        old_scale = self._scale()
+        image_x = self.canvas.canvasx(anchor_x) / old_scale
+        image_y = self.canvas.canvasy(anchor_y) / old_scale
+        
+        self.zoom = min(max(zoom, self.min_zoom), self.max_zoom)
+        self._update_view()
+        
+        scale = self._scale()
+        total_width, total_height = self._scrollregion_size()
+        self.canvas.xview_moveto(max(0, image_x * scale - anchor_x) / total_width)
+        self.canvas.yview_moveto(max(0, image_y * scale - anchor_y) / total_height)
+        self._schedule_render()
+
+    def _scrollregion_size(self):
+        height, width = self.pyramid[0].shape[:2]
+        scale = self._scale()
+        return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+    def _update_view(self):
+        if not self.pyramid:
+            return
+        total_width, total_height = self._scrollregion_size()
+        self.canvas.configure(scrollregion=(0, 0, total_width, total_height))
+        self._schedule_render()
+
+    def _schedule_render(self):
+        # Coalesce bursts of scroll/zoom events into one render
+        if not self._render_pending:
+            self._render_pending = True
+            self.after_idle(self._render)
+
+    def _render(self):
+        """Resample only the visible viewport from the closest pyramid level"""
+        self._render_pending = False
+        if not self.pyramid:
             return
-            
-        # Convert to RGB if needed
-        if len(img.shape) == 2:
-            img_rgb = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
-        else:
-            img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        
-        # Convert to PIL Image
-        self.image = Image.fromarray(img_rgb)
-        
-        # Calculate size maintaining aspect ratio
-        width, height = self.image.size
-        aspect_ratio = width / height
         
-        if width > height:
-            new_width = min(width, self.display_size[0])
-            new_height = int(new_width / aspect_ratio)
-        else:
-            new_height = min(height, self.display_size[1])
-            new_width = int(new_height * aspect_ratio)
+        scale = self._scale()
+        view_width, view_height = self._viewport_size()
+        
+        # Smallest level that still has at least as many pixels as the display needs
+        level = 0
+        while level + 1 < len(self.pyramid) and scale * 2 ** (level + 1) <= 1:
+            level += 1
+        src = self.pyramid[level]
+        src_height, src_width = src.shape[:2]
+        fx = scale * self.pyramid[0].shape[1] / src_width
+        fy = scale * self.pyramid[0].shape[0] / src_height
+        
+        # Visible region in level coordinates
+        left, top = self.canvas.canvasx(0), self.canvas.canvasy(0)
+        x0 = max(0, int(left / fx))
+        y0 = max(0, int(top / fy))
+        x1 = min(src_width, int(np.ceil((left + view_width) / fx)) + 1)
+        y1 = min(src_height, int(np.ceil((top + view_height) / fy)) + 1)
+        if x1 <= x0 or y1 <= y0:
+            return
         
-        # Resize image
-        resized_image = self.image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        out_width = max(1, int(round((x1 - x0) * fx)))
+        out_height = max(1, int(round((y1 - y0) * fy)))
+        interpolation = cv2.INTER_AREA if fx < 1 else cv2.INTER_NEAREST
+        viewport = cv2.resize(src[y0:y1, x0:x1], (out_width, out_height), interpolation=interpolation)
         
         # Create PhotoImage and display
-        self.photo = ImageTk.PhotoImage(resized_image)
+        self.photo = ImageTk.PhotoImage(Image.fromarray(viewport))
         self.canvas.delete("all")
-        self.canvas.create_image(0, 0, anchor="nw", image=self.photo)
-        self.canvas.configure(scrollregion=self.canvas.bbox("all"))
+        self.canvas.create_image(int(round(x0 * fx)), int(round(y0 * fy)), anchor="nw", image=self.photo)
+
+    def display_image(self, img):
+        if img is None:
+            return
+        
+        # The pyramid is built once per image; redisplaying the same array reuses it
+        if img is not self.image:
+            self.image = img
+            self.pyramid = build_pyramid(img)
+            self.zoom = 1.0
+        
+        self._update_view()
 
 class DewarpingGUI:
+    # (pipeline parameter, label, minimum, maximum, type) for the parameter sliders
+    PARAMETER_SLIDERS = [
+        ('peak_window', "Peak window", 20, 200, int),
+        ('peak_threshold', "Peak threshold", 0.1, 1.5, float),
+        ('window_height', "Line height", 10, 150, int),
+        ('sigma', "Smoothing", 0.5, 20.0, float),
+    ]
+
     def __init__(self):
         # Create the main window
         self.root = ctk.CTk()
@@ -257,17 +214,25 @@ class DewarpingGUI:
         self.root.geometry("1200x800")
         
         # Configure grid
-        self.root.grid_rowconfigure(1, weight=1)
+        self.root.grid_rowconfigure(2, weight=1)
         self.root.grid_columnconfigure(0, weight=1)
         
+        # Initialize variables
+        self.image_path = None
+        self.debug_images = None
+        self.worker = None
+        self.cancel_event = None
+        self.results = queue.Queue()
+        self.pipeline = None
+        self.parameters = {name: PagePipeline.DEFAULTS[name] for name, *_ in self.PARAMETER_SLIDERS}
+        self.rerun_pending = False
+        self._parameter_job = None
+        
         # Create frames
         self.create_toolbar()
+        self.create_parameter_bar()
         self.create_image_grid()
         self.create_status_bar()
-        
-        # Initialize variables
-        self.image_path = None
-        self.debug_images = None
 
     def create_toolbar(self):
         # Create toolbar frame
@@ -292,6 +257,15 @@ class DewarpingGUI:
         )
         self.process_btn.pack(side="left", padx=5)
         
+        self.cancel_btn = ctk.CTkButton(
+            toolbar,
+            text="Cancel",
+            command=self.cancel_processing,
+            width=120,
+            state="disabled"
+        )
+        self.cancel_btn.pack(side="left", padx=5)
+        
         self.save_btn = ctk.CTkButton(
             toolbar,
             text="Save Result",
@@ -301,10 +275,57 @@ class DewarpingGUI:
         )
         self.save_btn.pack(side="left", padx=5)
 
+    def create_parameter_bar(self):
+        # Create parameter frame
+        parameter_bar = ctk.CTkFrame(self.root)
+        parameter_bar.grid(row=1, column=0, sticky="ew", padx=10, pady=5)
+        
+        self.parameter_labels = {}
+        for name, text, minimum, maximum, kind in self.PARAMETER_SLIDERS:
+            label = ctk.CTkLabel(parameter_bar, text=self._parameter_text(name), width=130)
+            label.pack(side="left", padx=(10, 2))
+            self.parameter_labels[name] = label
+            
+            slider = ctk.CTkSlider(
+                parameter_bar,
+                from_=minimum,
+                to=maximum,
+                number_of_steps=int(maximum - minimum) if kind is int else 100,
+                command=lambda value, name=name: self.on_parameter_change(name, value),
+                width=140
+            )
+            slider.set(self.parameters[name])
+            slider.pack(side="left", padx=(2, 10))
+
+    def _parameter_text(self, name):
+        text = next(text for key, text, *_ in self.PARAMETER_SLIDERS if key == name)
+        value = self.parameters[name]
+        return f"{text}: {value:.2f}" if isinstance(value, float) else f"{text}: {value}"
+
+    def on_parameter_change(self, name, value):
+        kind = next(kind for key, *_, kind in self.PARAMETER_SLIDERS if key == name)
+        self.parameters[name] = kind(round(value)) if kind is int else float(value)
+        self.parameter_labels[name].configure(text=self._parameter_text(name))
+        
+        # Re-render once the slider settles, but only after a first manual run
+        if self.debug_images is not None:
+            if self._parameter_job is not None:
+                self.root.after_cancel(self._parameter_job)
+            self._parameter_job = self.root.after(150, self._rerun)
+
+    def _rerun(self):
+        self._parameter_job = None
+        if self.worker is not None:
+            # Restart with the new parameters once the current run has stopped
+            self.rerun_pending = True
+            self.cancel_event.set()
+        else:
+            self.process_image()
+
     def create_image_grid(self):
         # Create main display frame
         self.display_frame = ctk.CTkFrame(self.root)
-        self.display_frame.grid(row=1, column=0, sticky="nsew", padx=10, pady=5)
+        self.display_frame.grid(row=2, column=0, sticky="nsew", padx=10, pady=5)
         
         # Configure grid
         self.display_frame.grid_rowconfigure((0, 1), weight=1)
@@ -327,52 +348,118 @@ class DewarpingGUI:
     def create_status_bar(self):
         # Create status bar
         self.status_bar = ctk.CTkFrame(self.root)
-        self.status_bar.grid(row=2, column=0, sticky="ew", padx=10, pady=5)
+        self.status_bar.grid(row=3, column=0, sticky="ew", padx=10, pady=5)
         
         self.status_label = ctk.CTkLabel(self.status_bar, text="Ready")
         self.status_label.pack(side="left", padx=5)
+        
+        self.progress_bar = ctk.CTkProgressBar(self.status_bar, width=200)
+        self.progress_bar.set(0)
+        self.progress_bar.pack(side="right", padx=5)
 
     def select_image(self):
         self.image_path = filedialog.askopenfilename(
-            filetypes=[("Image files", "*.jpg *.jpeg *.png *.bmp *.tiff")]
+            filetypes=[("Image files", "*.jpg *.jpeg *.png *.bmp *.tiff *.npy")]
         )
         
         if self.image_path:
             try:
                 # Read and display original image
-                img = cv2.imread(self.image_path)
-                if img is not None:
-                    self.displays['Original'].display_image(img)
-                    self.process_btn.configure(state="normal")
-                    self.status_label.configure(text=f"Loaded: {os.path.basename(self.image_path)}")
-                else:
-                    raise ValueError("Failed to load image")
+                img = open_image(self.image_path)
+                self.displays['Original'].display_image(img)
+                self.process_btn.configure(state="normal")
+                self.status_label.configure(text=f"Loaded: {os.path.basename(self.image_path)}")
             except Exception as e:
                 self.status_label.configure(text=f"Error: {str(e)}")
 
     def process_image(self):
-        if self.image_path:
-            try:
-                self.status_label.configure(text="Processing...")
-                self.root.update()
-                
-                # Process image
-                debug_images = process_page_with_debug(self.image_path)
-                
-                if debug_images:
-                    # Display all images
-                    for title, img in debug_images.items():
-                        display_title = title.split('. ')[1]
-                        self.displays[display_title].display_image(img)
-                    
-                    self.save_btn.configure(state="normal")
-                    self.status_label.configure(text="Processing complete")
-                    self.debug_images = debug_images
+        if self.image_path and self.worker is None:
+            self.status_label.configure(text="Processing...")
+            self.progress_bar.set(0)
+            self.process_btn.configure(state="disabled")
+            self.select_btn.configure(state="disabled")
+            self.cancel_btn.configure(state="normal")
+            
+            # Reuse the memoized stages of the current image; only changed parameters recompute
+            if self.pipeline is None or self.pipeline.params['image_path'] != self.image_path:
+                self.pipeline = PagePipeline(self.image_path, **self.parameters)
+            else:
+                self.pipeline.set(**self.parameters)
+            
+            # Run the pipeline off the Tk thread; results come back through the queue
+            self.cancel_event = threading.Event()
+            self.worker = threading.Thread(
+                target=self._process_worker,
+                args=(self.pipeline, self.cancel_event),
+                daemon=True
+            )
+            self.worker.start()
+            self.root.after(50, self._poll_results)
+
+    def _process_worker(self, pipeline, cancel_event):
+        def progress(done, total):
+            self.results.put(('progress', done, total))
+        
+        try:
+            debug_images = pipeline.debug_images(progress=progress, cancel_event=cancel_event)
+            self.results.put(('done', debug_images))
+        except ProcessingCancelled:
+            self.results.put(('cancelled',))
+        except Exception as e:
+            self.results.put(('error', str(e)))
+
+    def _poll_results(self):
+        try:
+            while True:
+                message = self.results.get_nowait()
+                if message[0] == 'progress':
+                    _, done, total = message
+                    self.progress_bar.set(done / total if total else 1)
+                    self.status_label.configure(text=f"Processing line {done}/{total}...")
                 else:
-                    self.status_label.configure(text="Processing failed")
+                    self._finish_processing(message)
+                    return
+        except queue.Empty:
+            pass
+        
+        self.root.after(50, self._poll_results)
+
+    def _finish_processing(self, message):
+        self.worker = None
+        self.cancel_event = None
+        self.process_btn.configure(state="normal")
+        self.select_btn.configure(state="normal")
+        self.cancel_btn.configure(state="disabled")
+        
+        if message[0] == 'cancelled':
+            self.progress_bar.set(0)
+            self.status_label.configure(text="Processing cancelled")
+        elif message[0] == 'error':
+            self.status_label.configure(text=f"Error: {message[1]}")
+        elif message[1]:
+            debug_images = message[1]
             
-            except Exception as e:
-                self.status_label.configure(text=f"Error: {str(e)}")
+            # Display all images
+            for title, img in debug_images.items():
+                display_title = title.split('. ')[1]
+                self.displays[display_title].display_image(img)
+            
+            self.progress_bar.set(1)
+            self.save_btn.configure(state="normal")
+            self.status_label.configure(text="Processing complete")
+            self.debug_images = debug_images
+        else:
+            self.status_label.configure(text="Processing failed")
+        
+        if self.rerun_pending:
+            self.rerun_pending = False
+            self.process_image()
+
+    def cancel_processing(self):
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+            self.cancel_btn.configure(state="disabled")
+            self.status_label.configure(text="Cancelling...")
 
     def save_result(self):
         if self.debug_images and '4. Final Dewarped' in self.debug_images:
@@ -0,0 +1,92 @@
+"""
+Memory-mapped image input and output
+
+.npy files and headerless raw dumps are memory-mapped instead of decoded, so
+their pixels are paged in from disk as they are read and never copied into a
+second buffer. Results can likewise be written straight into a preallocated,
+file-backed buffer. Every other format is decoded by OpenCV as before.
+
+    page = open_image('scan.raw', cv2.IMREAD_GRAYSCALE, raw_shape=(7000, 5000))
+    out = create_output('dewarped.npy', page.shape)
+
+Both color-segmentation and document-dewarping carry an identical copy of this
+module so each runs on its own; change both copies together.
+"""
+
+import cv2
+import numpy as np
+
+ARRAY_EXTENSIONS = ('.npy',)
+RAW_EXTENSIONS = ('.raw', '.bin')
+MAPPED_EXTENSIONS = ARRAY_EXTENSIONS + RAW_EXTENSIONS
+
+def is_mapped(path):
+    """Whether `path` is read and written through a memory map rather than a codec"""
+    return path.lower().endswith(MAPPED_EXTENSIONS)
+
+def map_image(path, raw_shape=None, raw_dtype='uint8', raw_offset=0):
+    """Read-only memory map of a .npy file or of a raw dump with the given shape, dtype and header size"""
+    if path.lower().endswith(ARRAY_EXTENSIONS):
+        return np.load(path, mmap_mode='r')
+    if raw_shape is None:
+        raise ValueError(f"Raw input needs its shape: {path}")
+    return np.memmap(path, dtype=raw_dtype, mode='r', offset=raw_offset, shape=tuple(raw_shape))
+
+def to_uint8(image):
+    """Return 8-bit pixels unchanged and scale wider integer samples down to 8 bits"""
+    if image.dtype == np.uint8:
+        return image
+    if not np.issubdtype(image.dtype, np.integer):
+        raise ValueError(f"Unsupported pixel type: {image.dtype}")
+    return cv2.convertScaleAbs(image, alpha=255.0 / np.iinfo(image.dtype).max)
+
+def match_channels(image, flags=cv2.IMREAD_COLOR):
+    """Convert an image to BGR or grayscale as requested by the cv2.imread `flags`"""
+    if image.ndim == 3 and image.shape[2] == 1:
+        # Drop the singleton channel axis as a view
+        image = image[:, :, 0]
+
+    if flags == cv2.IMREAD_GRAYSCALE and image.ndim == 3:
+        code = cv2.COLOR_BGRA2GRAY if image.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+        return cv2.cvtColor(image, code)
+    if flags == cv2.IMREAD_COLOR and image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    if flags == cv2.IMREAD_COLOR and image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+    return image
+
+def open_image(path, flags=cv2.IMREAD_COLOR, raw_shape=None, raw_dtype='uint8', raw_offset=0):
+    """Open an 8-bit image, memory-mapping .npy and raw inputs
+
+    A mapped file already in the requested layout is returned as the map
+    itself, with no copy; only a channel or bit depth conversion allocates.
+    """
+    if is_mapped(path):
+        image = map_image(path, raw_shape, raw_dtype, raw_offset)
+        return match_channels(to_uint8(image), flags)
+
+    image = cv2.imread(path, flags)
+    if image is None:
+        raise ValueError(f"Failed to load image: {path}")
+    return image
+
+def create_output(path, shape, dtype=np.uint8):
+    """Preallocate a writable result buffer backed by `path`, as .npy or as a raw dump"""
+    if path.lower().endswith(ARRAY_EXTENSIONS):
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=tuple(shape))
+    return np.memmap(path, dtype=dtype, mode='w+', shape=tuple(shape))
+
+def parse_shape(text):
+    """Parse HEIGHTxWIDTH or HEIGHTxWIDTHxCHANNELS"""
+    return tuple(int(n) for n in text.lower().split('x'))
+
+def add_raw_arguments(parser):
+    """Add the options describing headerless raw inputs to an argparse parser"""
+    parser.add_argument('--raw-shape', type=parse_shape,
+                        help="Shape of .raw/.bin inputs as HEIGHTxWIDTH or HEIGHTxWIDTHxCHANNELS")
+    parser.add_argument('--raw-dtype', default='uint8', help="Sample type of raw inputs, e.g. uint8 or uint16")
+    parser.add_argument('--raw-offset', type=int, default=0, help="Header bytes to skip in raw inputs")
+
+def raw_options(args):
+    """open_image() keyword arguments from parsed add_raw_arguments() options"""
+    return {'raw_shape': args.raw_shape, 'raw_dtype': args.raw_dtype, 'raw_offset': args.raw_offset}
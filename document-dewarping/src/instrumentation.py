@@ -0,0 +1,194 @@
+"""
+Per-stage timing and memory instrumentation
+
+Pipeline stages are wrapped in spans that record wall time, process CPU time,
+the input image shape and, optionally, bytes allocated. Nothing is recorded
+until enable() is called; while disabled a span costs one global lookup.
+
+    recorder = instrumentation.enable(sink=open('spans.jsonl', 'w'))
+    ...
+    print(json.dumps(recorder.summary()))
+
+Both color-segmentation and document-dewarping carry an identical copy of this
+module so each runs on its own; change both copies together.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+# Upper bounds in seconds of the wall time histogram buckets
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, float('inf'))
+
+_recorder = None
+
+class Recorder:
+    """Collects span events, writing each as a JSON line and aggregating them per stage
+
+    Aggregates are bucketed so memory stays constant however many spans are
+    recorded. With `keep` the raw events are also held until drain(), which is
+    how worker processes hand their spans back to the parent.
+    """
+
+    def __init__(self, sink=None, memory=False, keep=False):
+        self.sink = sink
+        self.memory = memory
+        self.keep = keep
+        self.events = []
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        with self._lock:
+            stage = self.stages.get(event['stage'])
+            if stage is None:
+                stage = self.stages[event['stage']] = {
+                    'count': 0, 'wall': 0.0, 'wall_max': 0.0, 'cpu': 0.0,
+                    'bytes': 0, 'bytes_max': 0, 'histogram': [0] * len(BUCKETS),
+                }
+            stage['count'] += 1
+            stage['wall'] += event['wall']
+            stage['wall_max'] = max(stage['wall_max'], event['wall'])
+            stage['cpu'] += event['cpu']
+            if 'bytes' in event:
+                stage['bytes'] += event['bytes']
+                stage['bytes_max'] = max(stage['bytes_max'], event['bytes'])
+            stage['histogram'][int(np.searchsorted(BUCKETS, event['wall']))] += 1
+
+            if self.keep:
+                self.events.append(event)
+            if self.sink is not None:
+                self.sink.write(json.dumps(event) + "\n")
+                self.sink.flush()
+
+    def drain(self):
+        """Return and forget the events kept since the last drain"""
+        with self._lock:
+            events, self.events = self.events, []
+        return events
+
+    def merge(self, events):
+        """Record events collected by another recorder, such as one in a worker process"""
+        for event in events:
+            self.record(event)
+
+    def summary(self):
+        """Per-stage totals, means, maxima and wall time histograms"""
+        with self._lock:
+            summary = {}
+            for name, stage in self.stages.items():
+                count = stage['count']
+                summary[name] = {
+                    'count': count,
+                    'wall_total': stage['wall'],
+                    'wall_mean': stage['wall'] / count,
+                    'wall_max': stage['wall_max'],
+                    'cpu_total': stage['cpu'],
+                    'cpu_mean': stage['cpu'] / count,
+                    'histogram': {('+Inf' if bound == float('inf') else str(bound)): n
+                                  for bound, n in zip(BUCKETS, stage['histogram'])},
+                }
+                if self.memory:
+                    summary[name]['bytes_mean'] = stage['bytes'] / count
+                    summary[name]['bytes_max'] = stage['bytes_max']
+            return summary
+
+class _Span:
+    # Open spans per thread, so nested spans can pass their allocation peak up
+    _local = threading.local()
+
+    def __init__(self, recorder, stage, image, fields):
+        self.recorder = recorder
+        self.event = {'stage': stage, 'pid': os.getpid()}
+        if image is not None:
+            self.event['shape'] = list(image.shape)
+        self.event.update(fields)
+
+    def __enter__(self):
+        if self.recorder.memory:
+            stack = self._local.__dict__.setdefault('stack', [])
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            self.start_bytes = self.peak = current
+            stack.append(self)
+
+        self.start_cpu = time.process_time()
+        self.start_wall = time.perf_counter()
+        return self.event
+
+    def __exit__(self, exc_type, exc, tb):
+        self.event['wall'] = time.perf_counter() - self.start_wall
+        self.event['cpu'] = time.process_time() - self.start_cpu
+
+        if self.recorder.memory:
+            stack = self._local.stack
+            stack.pop()
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+            self.event['bytes'] = self.peak - self.start_bytes
+
+        if exc_type is not None:
+            self.event['error'] = exc_type.__name__
+        self.recorder.record(self.event)
+        return False
+
+class _NullSpan:
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+def enable(sink=None, memory=False, keep=False):
+    """Start recording spans in this process and return the Recorder
+
+    With `memory` tracemalloc is started and each span also records the peak
+    bytes allocated above its starting point. Tracing slows allocation-heavy
+    code noticeably and is process-wide, so concurrent spans see each other's
+    allocations. CPU time is also process-wide, which includes OpenCV's own
+    threads.
+    """
+    global _recorder
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _recorder = Recorder(sink, memory, keep)
+    return _recorder
+
+def disable():
+    global _recorder
+    if _recorder is not None and _recorder.memory:
+        tracemalloc.stop()
+    _recorder = None
+
+def active():
+    """The current Recorder, or None while instrumentation is disabled"""
+    return _recorder
+
+def span(stage, image=None, **fields):
+    """Context manager timing one stage; yields the event dict so extra fields can be added"""
+    if _recorder is None:
+        return _NULL_SPAN
+    return _Span(_recorder, stage, image, fields)
+
+def instrumented(stage):
+    """Decorator wrapping every call in a span, using the first array argument as the image"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return func(*args, **kwargs)
+            image = next((arg for arg in args if isinstance(arg, np.ndarray)), None)
+            with _Span(_recorder, stage, image, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,137 @@
+"""
+Content-addressed on-disk cache for intermediate dewarping results
+"""
+
+import hashlib
+import os
+
+import cv2
+import numpy as np
+
+from dewarp_pipeline import (
+    find_text_lines, fit_lines, preprocess_image, sample_curves, warp_from_samples
+)
+
+# Bump when a cached stage's algorithm changes so stale entries stop matching
+CACHE_VERSION = 2
+
+class ResultCache:
+    """Stores .npz entries keyed by a hash of their inputs, evicting the least recently used
+
+    Entries are zlib-compressed, which shrinks the mostly white binary pages
+    many times over so the cache holds whole books. Every hit refreshes the
+    entry's modification time, which is the LRU order used once the cache
+    grows past `max_bytes`.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """Hash arrays by shape, dtype and content, and everything else by repr"""
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(repr(CACHE_VERSION).encode('utf-8'))
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                digest.update(repr((part.shape, part.dtype.str)).encode('utf-8'))
+                digest.update(np.ascontiguousarray(part).data)
+            else:
+                digest.update(repr(part).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def get(self, key):
+        """Return the stored arrays as a dict, or None on a miss"""
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+            os.utime(path)
+            return arrays
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, **arrays):
+        path = self._path(key)
+        # Write then rename so concurrent readers never see a partial entry
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not write cache entry: {str(e)}")
+            return
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npz'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                total -= size
+            except OSError:
+                pass
+
+    def cached(self, key, compute):
+        """Return the cached arrays for key, computing and storing them on a miss"""
+        arrays = self.get(key)
+        if arrays is None:
+            arrays = compute()
+            self.put(key, **arrays)
+        return arrays
+
+def process_page_cached(original, cache, image=None, interpolation=None, clip_limit=2.0, tile_grid_size=(8, 8),
+                        window=80, threshold=0.5, window_height=50, sigma=2.0, workers=None, out=None):
+    """Binarize and dewarp a page, reusing cached stages where their inputs are unchanged
+
+    Each stage is keyed by the key of the stage before it plus its own
+    parameters, so changing only dewarp parameters reuses the cached binary and
+    line positions. Returns the binary image, line positions, the (n_lines,
+    width) curve samples and the dewarped page, which is written into `out`
+    when given.
+    """
+    binary_key = cache.key('binary', original, clip_limit, tuple(tile_grid_size))
+    binary = cache.cached(
+        binary_key,
+        lambda: {'binary': preprocess_image(original, clip_limit, tuple(tile_grid_size))}
+    )['binary']
+
+    lines_key = cache.key('lines', binary_key, window, threshold)
+    line_positions = cache.cached(
+        lines_key,
+        lambda: {'positions': np.array(find_text_lines(binary, window, threshold), dtype=np.int64)}
+    )['positions']
+
+    def compute_samples():
+        curves = fit_lines(binary, [int(y) for y in line_positions], window_height, workers=workers)
+        return {'samples': sample_curves(curves, binary.shape[0], binary.shape[1], window_height, sigma)}
+
+    samples_key = cache.key('samples', lines_key, window_height, sigma)
+    samples = cache.cached(samples_key, compute_samples)['samples']
+
+    source = binary if image is None else image
+    if interpolation is None:
+        interpolation = cv2.INTER_NEAREST if image is None else cv2.INTER_LINEAR
+    dewarped = warp_from_samples(source, samples, interpolation, out)
+
+    return binary, line_positions, samples, dewarped
@@ -0,0 +1,188 @@
+"""
+Timing, peak memory and correctness benchmarks for noise estimation
+
+Run from the repository root or this folder:
+
+    python noise-estimation/benchmarks/bench_noise.py --sizes 256 1024 --repeat 5
+
+Exits with status 1 if the stacked features or noise types of any generated
+test image differ from a literal per-image port of estimate_noise.m, or if
+the sampled fast mode returns a different noise type than the full one.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from noise_estimation import FEATURE_NAMES, classify, estimate_noise_sampled, extract_features, remove_noise
+from noise_generation import NOISE_SUFFIXES, add_noise, make_chessboard
+
+def measure(fn, repeat):
+    """Median wall time over `repeat` runs and peak traced allocation of one extra run"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, float(np.median(times)), peak
+
+def reference_estimate_noise(image):
+    """Line-by-line port of estimate_noise.m for one image, kept as a regression reference
+
+    Returns the noise type and a dict of the statistics it printed.
+    """
+    height, width = image.shape
+
+    # [Gx, Gy] = imgradientxy(noisy_image), Sobel with replicated borders
+    padded = np.pad(image, 1, mode='edge')
+    def shifted(dy, dx):
+        return padded[1 + dy:1 + dy + height, 1 + dx:1 + dx + width]
+    gx = (shifted(-1, 1) + 2 * shifted(0, 1) + shifted(1, 1)) - (shifted(-1, -1) + 2 * shifted(0, -1) + shifted(1, -1))
+    gy = (shifted(1, -1) + 2 * shifted(1, 0) + shifted(1, 1)) - (shifted(-1, -1) + 2 * shifted(-1, 0) + shifted(-1, 1))
+    edge_mag = np.sqrt(gx**2 + gy**2)
+    non_edge_mask = ~(edge_mag > 0.1)
+
+    # noisy_image(non_edge_mask) gathers pixels in column-major order
+    non_edge_pixels = image.T[non_edge_mask.T]
+    if len(non_edge_pixels) == 0:
+        return 'unknown', {name: float('nan') for name in FEATURE_NAMES}
+
+    # stdfilt(noisy_image).^2, the unbiased variance of each symmetrically padded 3x3 window
+    windows = sliding_window_view(np.pad(image, 1, mode='symmetric'), (3, 3))
+    local_var = windows.reshape(height, width, 9).std(axis=2, ddof=1)**2
+    mean_local_var = local_var[non_edge_mask].mean()
+
+    # skewness() and kurtosis() with their default bias flag of 1
+    deviation = non_edge_pixels - non_edge_pixels.mean()
+    m2 = np.mean(deviation**2)
+    noise_skewness = np.mean(deviation**3) / m2**1.5
+    noise_kurtosis = np.mean(deviation**4) / m2**2
+    noise_range = non_edge_pixels.max() - non_edge_pixels.min()
+
+    extreme_ratio = np.sum((non_edge_pixels < 0.1) | (non_edge_pixels > 0.9)) / len(non_edge_pixels)
+    variation_metric = np.mean(np.abs(np.diff(non_edge_pixels)))
+
+    if extreme_ratio > 0.1 and variation_metric > 0.2:
+        noise_type = 'salt & pepper'
+    elif abs(noise_skewness) < 0.3 and abs(noise_kurtosis - 3) < 1 and mean_local_var < 0.1:
+        noise_type = 'gaussian'
+    elif abs(noise_skewness) < 0.2 and abs(noise_kurtosis - 1.8) < 0.5 and noise_range < 0.5:
+        noise_type = 'uniform'
+    elif noise_skewness > 0.5 and noise_skewness < 2 and mean_local_var > 0.05:
+        noise_type = 'rayleigh'
+    elif noise_skewness > 1 and noise_kurtosis > 4:
+        noise_type = 'exponential'
+    else:
+        noise_type = 'unknown'
+
+    return noise_type, {
+        'mean_local_var': mean_local_var,
+        'skewness': noise_skewness,
+        'kurtosis': noise_kurtosis,
+        'range': noise_range,
+        'extreme_ratio': extreme_ratio,
+        'variation_metric': variation_metric,
+    }
+
+def matches_reference(stack):
+    """Whether extract_features() and classify() reproduce reference_estimate_noise() on every image"""
+    features = extract_features(stack)
+    noise_types = classify(features)
+    for position, image in enumerate(stack):
+        expected_type, expected = reference_estimate_noise(image)
+        if noise_types[position] != expected_type:
+            return False
+        for name in FEATURE_NAMES:
+            if not np.allclose(features[name][position], expected[name], rtol=1e-9, atol=1e-12, equal_nan=True):
+                return False
+    return True
+
+def make_test_set(size, boards, seed):
+    """Every noise type of NoiseGeneration.m on chessboards of several square counts, quantized to 8 bits"""
+    rng = np.random.default_rng(seed)
+    images = [add_noise(make_chessboard(size, squares=4 + 2 * number), suffix, rng)
+              for number in range(1, boards + 1) for suffix in NOISE_SUFFIXES]
+    return np.floor(np.stack(images) * 255 + 0.5) / 255
+
+def run(sizes, repeat, boards, seed):
+    rows = []
+
+    for size in sizes:
+        stack = make_test_set(size, boards, seed)
+        noise_types = classify(extract_features(stack))
+
+        stages = [
+            ('reference', lambda: [reference_estimate_noise(image) for image in stack]),
+            ('features', lambda: extract_features(stack)),
+            ('classify', lambda: classify(extract_features(stack))),
+            ('sampled', lambda: estimate_noise_sampled(stack)),
+            ('remove_noise', lambda: remove_noise(stack, noise_types)),
+        ]
+
+        results = {}
+        for name, fn in stages:
+            results[name], seconds, peak = measure(fn, repeat)
+            rows.append({
+                'stage': name,
+                'size': f"{size}x{size}",
+                'images': len(stack),
+                'seconds': seconds,
+                'ms_per_image': seconds * 1000 / len(stack),
+                'peak_bytes': peak,
+            })
+
+        sampled_types, _, _, sampled = results['sampled']
+        rows.append({
+            'stage': 'correctness',
+            'size': f"{size}x{size}",
+            'matches_reference': matches_reference(stack),
+            'sampled_agrees': bool(np.all(sampled_types == noise_types)),
+            'sampled_share': float(sampled.mean()),
+        })
+        rows[-1]['correct'] = rows[-1]['matches_reference'] and rows[-1]['sampled_agrees']
+
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark noise estimation against a per-image reference port")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024], help="Square image sizes")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per stage")
+    parser.add_argument('--boards', type=int, default=3, help="Chessboards per size, each with every noise type")
+    parser.add_argument('--seed', type=int, default=0, help="Noise generator seed")
+    parser.add_argument('--json', help="Also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    rows = run(args.sizes, args.repeat, args.boards, args.seed)
+
+    print(f"{'stage':<15}{'size':>12}{'ms':>10}{'ms/image':>10}{'peak MB':>10}")
+    for row in rows:
+        if row['stage'] == 'correctness':
+            print(f"{'correctness':<15}{row['size']:>12}  matches reference "
+                  f"{'yes' if row['matches_reference'] else 'NO'}, sampled agrees "
+                  f"{'yes' if row['sampled_agrees'] else 'NO'} ({row['sampled_share']:.0%} sampled)")
+        else:
+            print(f"{row['stage']:<15}{row['size']:>12}{row['seconds'] * 1000:>10.1f}"
+                  f"{row['ms_per_image']:>10.2f}{row['peak_bytes'] / 1e6:>10.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+    return 0 if all(row['correct'] for row in rows if row['stage'] == 'correctness') else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
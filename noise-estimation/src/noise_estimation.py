@@ -0,0 +1,536 @@
+"""
+Batch noise type estimation and removal, ported from estimate_noise.m and remove_noise.m
+"""
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import cv2
+import numpy as np
+from scipy.ndimage import correlate1d, gaussian_filter, median_filter, uniform_filter
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+# Classification order of estimate_noise.m; the first matching rule wins
+NOISE_TYPES = ('salt & pepper', 'gaussian', 'uniform', 'rayleigh', 'exponential', 'unknown')
+FEATURE_NAMES = ('mean_local_var', 'skewness', 'kurtosis', 'range', 'extreme_ratio', 'variation_metric')
+
+# Pixels stacked per vectorized pass in a worker; the filters need several float64 copies of each stack
+STACK_PIXELS = 1 << 22
+
+# rgb2gray luminance weights
+GRAY_WEIGHTS = (0.298936021293775, 0.587043074451121, 0.114020904255103)
+
+def im2double(image):
+    """Scale an image to [0, 1] floats like MATLAB's im2double"""
+    if image.dtype == np.bool_:
+        return image.astype(np.float64)
+    if image.dtype == np.int16:
+        return (image.astype(np.float64) + 32768) / 65535
+    if np.issubdtype(image.dtype, np.integer):
+        return image / float(np.iinfo(image.dtype).max)
+    return image.astype(np.float64, copy=False)
+
+def bgr_to_gray(image):
+    """Convert a BGR image to grayscale like MATLAB's rgb2gray, keeping 8-bit input 8-bit"""
+    blue, green, red = (image[..., i].astype(np.float64) for i in range(3))
+    gray = GRAY_WEIGHTS[0] * red + GRAY_WEIGHTS[1] * green + GRAY_WEIGHTS[2] * blue
+    if np.issubdtype(image.dtype, np.integer):
+        return np.floor(gray + 0.5).astype(image.dtype)
+    return gray
+
+def load_image(path):
+    """Read an image as a 2D float64 array in [0, 1]"""
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError(f"Failed to load image: {path}")
+    if image.ndim == 3:
+        image = bgr_to_gray(image[..., :3])
+    return im2double(image)
+
+def to_uint8(image):
+    """Round a [0, 1] float image to 8 bits like MATLAB's imwrite"""
+    image = np.clip(np.nan_to_num(image), 0, 1)
+    return np.floor(image * 255 + 0.5).astype(np.uint8)
+
+def as_stack(images):
+    """View a single 2D image or an (N, H, W) batch as a float64 stack"""
+    stack = np.asarray(images, dtype=np.float64)
+    return stack[None] if stack.ndim == 2 else stack
+
+def sobel_magnitude(stack):
+    """Gradient magnitude of every image like imgradientxy's Sobel with replicated borders"""
+    gx = correlate1d(correlate1d(stack, [-1, 0, 1], axis=-1, mode='nearest'), [1, 2, 1], axis=-2, mode='nearest')
+    gy = correlate1d(correlate1d(stack, [-1, 0, 1], axis=-2, mode='nearest'), [1, 2, 1], axis=-1, mode='nearest')
+    return np.hypot(gx, gy)
+
+def local_variance(stack):
+    """Unbiased 3x3 variance of every image, matching stdfilt(...).^2 with symmetric padding"""
+    mean = uniform_filter(stack, size=(1, 3, 3), mode='reflect')
+    mean_sq = uniform_filter(stack * stack, size=(1, 3, 3), mode='reflect')
+    return np.maximum((mean_sq - mean * mean) * (9 / 8), 0)
+
+def extract_features(images):
+    """Compute the estimate_noise.m statistics for a stack of same-sized images at once
+
+    Statistics are taken over the non-edge pixels of each image (Sobel magnitude
+    at most 0.1). Returns a dict mapping each of FEATURE_NAMES, plus 'n_pixels',
+    to an array with one value per image; images without non-edge pixels get NaN.
+    """
+    stack = as_stack(images)
+    n_images = len(stack)
+    non_edge = sobel_magnitude(stack) <= 0.1
+    counts = np.count_nonzero(non_edge, axis=(1, 2))
+
+    # MATLAB gathers masked pixels in column-major order, which the variation metric depends on
+    mask = non_edge.transpose(0, 2, 1)
+    pixels = stack.transpose(0, 2, 1)[mask]
+    image_ids = np.nonzero(mask)[0]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_local_var = np.where(non_edge, local_variance(stack), 0).sum(axis=(1, 2)) / counts
+
+        mean = np.bincount(image_ids, weights=pixels, minlength=n_images) / counts
+        deviation = pixels - mean[image_ids]
+        squared = deviation * deviation
+        m2 = np.bincount(image_ids, weights=squared, minlength=n_images) / counts
+        m3 = np.bincount(image_ids, weights=squared * deviation, minlength=n_images) / counts
+        m4 = np.bincount(image_ids, weights=squared * squared, minlength=n_images) / counts
+        skewness = m3 / m2**1.5
+        kurtosis = m4 / (m2 * m2)
+
+        extreme = (pixels < 0.1) | (pixels > 0.9)
+        extreme_ratio = np.bincount(image_ids, weights=extreme, minlength=n_images) / counts
+
+        # Differences between consecutive pixels of the same image only
+        same_image = image_ids[1:] == image_ids[:-1]
+        differences = np.abs(np.diff(pixels))[same_image]
+        variation_metric = (np.bincount(image_ids[1:][same_image], weights=differences, minlength=n_images) /
+                            (counts - 1))
+
+    # Pixels are grouped by image, so each non-empty image is one reduceat segment
+    value_range = np.full(n_images, np.nan)
+    present = counts > 0
+    if present.any():
+        starts = (np.cumsum(counts) - counts)[present]
+        value_range[present] = np.maximum.reduceat(pixels, starts) - np.minimum.reduceat(pixels, starts)
+
+    return {
+        'mean_local_var': mean_local_var,
+        'skewness': skewness,
+        'kurtosis': kurtosis,
+        'range': value_range,
+        'extreme_ratio': extreme_ratio,
+        'variation_metric': variation_metric,
+        'n_pixels': counts,
+    }
+
+def classify(features):
+    """Noise type name of every image from extract_features() output, using the thresholds of estimate_noise.m"""
+    local_var = features['mean_local_var']
+    skewness = features['skewness']
+    kurtosis = features['kurtosis']
+
+    rules = [
+        (features['extreme_ratio'] > 0.1) & (features['variation_metric'] > 0.2),
+        (np.abs(skewness) < 0.3) & (np.abs(kurtosis - 3) < 1) & (local_var < 0.1),
+        (np.abs(skewness) < 0.2) & (np.abs(kurtosis - 1.8) < 0.5) & (features['range'] < 0.5),
+        (skewness > 0.5) & (skewness < 2) & (local_var > 0.05),
+        (skewness > 1) & (kurtosis > 4),
+    ]
+    index = np.select(rules, range(len(rules)), default=len(rules))
+    return np.asarray(NOISE_TYPES)[index]
+
+def sample_columns(shape, budget=65536, min_columns=8, rng=None):
+    """Indices of about budget / height columns, one at a random spot in each equal-width band
+
+    Columns keep one pixel clear of the left and right edges so they can be
+    read with a one column halo.
+    """
+    rng = rng if rng is not None else np.random.default_rng(0)
+    height, width = shape[-2:]
+    n_columns = int(np.clip(budget // height, min_columns, width - 2))
+    edges = np.linspace(1, width - 1, n_columns + 1)
+    return (edges[:-1] + rng.random(n_columns) * np.diff(edges)).astype(np.intp)
+
+def column_statistics(stack, xs):
+    """Per-column sums from which extract_features()' statistics can be rebuilt
+
+    Whole columns are sampled because the variation metric follows MATLAB's
+    column-major pixel order: consecutive non-edge pixels of a column are
+    consecutive there too, however far apart they are. Each column is read with
+    its neighbours so its Sobel and local variance values are exactly those of
+    the full image. Returns a dict of (n_images, n_columns) arrays; pixel powers
+    are taken around each image's sample mean ('center') to keep the moment
+    sums well conditioned.
+    """
+    n_images, height = stack.shape[:2]
+    n_columns = len(xs)
+    halo = stack[:, :, xs[:, None] + np.arange(-1, 2)].transpose(0, 2, 1, 3).reshape(-1, height, 3)
+
+    non_edge = (sobel_magnitude(halo) <= 0.1)[:, :, 1]
+    local_var = local_variance(halo)[:, :, 1]
+    pixels = halo[:, :, 1]
+    shape = (n_images, n_columns)
+
+    counts = np.count_nonzero(non_edge, axis=1)
+    center = (np.where(non_edge, pixels, 0).reshape(n_images, -1).sum(axis=1) /
+              np.maximum(counts.reshape(shape).sum(axis=1), 1))
+    deviation = np.where(non_edge, pixels - np.repeat(center, n_columns)[:, None], 0)
+    squared = deviation * deviation
+
+    column_ids, rows = np.nonzero(non_edge)
+    values = pixels[column_ids, rows]
+    same_column = column_ids[1:] == column_ids[:-1]
+    differences = np.abs(np.diff(values))[same_column]
+
+    return {
+        'center': center,
+        'count': counts.reshape(shape),
+        'sum1': deviation.sum(axis=1).reshape(shape),
+        'sum2': squared.sum(axis=1).reshape(shape),
+        'sum3': (squared * deviation).sum(axis=1).reshape(shape),
+        'sum4': (squared * squared).sum(axis=1).reshape(shape),
+        'local_var': np.where(non_edge, local_var, 0).sum(axis=1).reshape(shape),
+        'extreme': np.count_nonzero(non_edge & ((pixels < 0.1) | (pixels > 0.9)), axis=1).reshape(shape),
+        'diff_sum': np.bincount(column_ids[1:][same_column], weights=differences,
+                                minlength=n_images * n_columns).reshape(shape),
+        'diff_count': np.maximum(counts - 1, 0).reshape(shape),
+        'min': np.where(non_edge, pixels, np.inf).min(axis=1).reshape(shape),
+        'max': np.where(non_edge, pixels, -np.inf).max(axis=1).reshape(shape),
+    }
+
+def features_from_statistics(stats, weights):
+    """Statistics of every image under each (n_replicates, n_columns) column weighting
+
+    Returns a features dict of (n_images, n_replicates) arrays.
+    """
+    def total(name):
+        return stats[name] @ weights.T
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        count = total('count')
+        mean = total('sum1') / count
+        raw2, raw3, raw4 = total('sum2') / count, total('sum3') / count, total('sum4') / count
+        m2 = raw2 - mean**2
+        m3 = raw3 - 3 * mean * raw2 + 2 * mean**3
+        m4 = raw4 - 4 * mean * raw3 + 6 * mean**2 * raw2 - 3 * mean**4
+        used = weights[None, :, :] > 0
+        value_range = (np.where(used, stats['max'][:, None, :], -np.inf).max(axis=2) -
+                       np.where(used, stats['min'][:, None, :], np.inf).min(axis=2))
+
+        return {
+            'mean_local_var': total('local_var') / count,
+            'skewness': m3 / m2**1.5,
+            'kurtosis': m4 / (m2 * m2),
+            'range': np.where(np.isfinite(value_range), value_range, np.nan),
+            'extreme_ratio': total('extreme') / count,
+            'variation_metric': total('diff_sum') / total('diff_count'),
+            'n_pixels': count,
+        }
+
+def estimate_noise_sampled(images, budget=65536, min_columns=8, n_bootstrap=200, min_confidence=0.95, margin=0.1,
+                           seed=0):
+    """Classify a stack of same-sized images from a stratified sample of whole columns
+
+    About `budget` pixels (at least `min_columns` columns) per image are
+    sampled, so the cost does not grow with image area. Confidence is the
+    share of column bootstrap replicates that agree with the sampled
+    classification; images below `min_confidence`, which sit close to a
+    decision threshold, are recomputed in full with extract_features(), as
+    are images too small for sampling to pay off.
+
+    The bootstrap cannot see two biases of the sample: its range is only a
+    lower bound of the full range, and its variation metric leaves out the
+    differences across column boundaries, running a few percent low. Images
+    whose sampled range is below the uniform threshold by less than `margin`
+    of it, or whose variation metric is within `margin` of the salt & pepper
+    threshold, are therefore recomputed as well.
+
+    Returns (noise_types, features, confidence, sampled) where `sampled` is
+    False for images that were computed in full, which have confidence 1.
+    """
+    stack = as_stack(images)
+    n_images = len(stack)
+    height, width = stack.shape[1:]
+
+    if height * width <= 2 * budget or width < 4 * min_columns:
+        features = extract_features(stack)
+        return classify(features), features, np.ones(n_images), np.zeros(n_images, dtype=bool)
+
+    rng = np.random.default_rng(seed)
+    xs = sample_columns(stack.shape, budget, min_columns, rng)
+    stats = column_statistics(stack, xs)
+
+    # Replicate 0 is the sample itself, the rest resample its columns with replacement
+    n_columns = len(xs)
+    weights = np.vstack([np.ones(n_columns),
+                         rng.multinomial(n_columns, np.full(n_columns, 1 / n_columns), size=n_bootstrap)])
+    replicates = features_from_statistics(stats, weights)
+    labels = classify(replicates)
+
+    features = {name: values[:, 0] for name, values in replicates.items()}
+    noise_types = labels[:, 0]
+    confidence = (labels[:, 1:] == noise_types[:, None]).mean(axis=1)
+
+    # Thresholds of the range and variation metric rules of classify()
+    value_range, variation = features['range'], features['variation_metric']
+    near_threshold = (((value_range >= 0.5 * (1 - margin)) & (value_range < 0.5)) |
+                      (np.abs(variation - 0.2) <= 0.2 * margin))
+    sampled = (confidence >= min_confidence) & ~near_threshold
+
+    uncertain = np.flatnonzero(~sampled)
+    if len(uncertain):
+        full = extract_features(stack[uncertain])
+        noise_types[uncertain] = classify(full)
+        for name in features:
+            features[name][uncertain] = full[name]
+        confidence[uncertain] = 1.0
+
+    return noise_types, features, confidence, sampled
+
+def median_denoise(stack):
+    """3x3 median filter with zero padding, as medfilt2"""
+    return median_filter(stack, size=(1, 3, 3), mode='constant', cval=0.0)
+
+def gaussian_denoise(stack):
+    """5x5 sigma 1 Gaussian with replicated borders, as imfilter(fspecial('gaussian', [5 5], 1))"""
+    return gaussian_filter(stack, sigma=(0, 1, 1), truncate=2.0, mode='nearest')
+
+def wiener_denoise(stack, size=5):
+    """Adaptive Wiener filter with zero padding, as wiener2 with the noise power estimated per image"""
+    local_mean = uniform_filter(stack, size=(1, size, size), mode='constant')
+    local_var = uniform_filter(stack * stack, size=(1, size, size), mode='constant') - local_mean * local_mean
+    noise = local_var.mean(axis=(1, 2), keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gain = np.maximum(local_var - noise, 0) / np.maximum(local_var, noise)
+    return local_mean + gain * (stack - local_mean)
+
+# Denoiser per noise type as in remove_noise.m; anything else gets the median filter
+DENOISERS = {
+    'salt & pepper': median_denoise,
+    'gaussian': gaussian_denoise,
+    'uniform': wiener_denoise,
+    'rayleigh': wiener_denoise,
+    'exponential': wiener_denoise,
+}
+
+def remove_noise(images, noise_types):
+    """Denoise a stack of same-sized images, running each denoiser once on all images that need it"""
+    stack = as_stack(images)
+    noise_types = np.atleast_1d(np.asarray(noise_types))
+    denoised = np.empty_like(stack)
+
+    denoisers = np.array([DENOISERS.get(str(noise_type), median_denoise) for noise_type in noise_types])
+    for denoiser in set(denoisers):
+        index = np.flatnonzero(denoisers == denoiser)
+        denoised[index] = denoiser(stack[index])
+
+    return denoised[0] if np.ndim(images) == 2 else denoised
+
+def estimate_noise(image):
+    """Noise type name of a single image"""
+    return str(classify(extract_features(im2double(np.asarray(image))))[0])
+
+def group_by_shape(images):
+    """Indices of the images sharing each shape, so every group can be stacked"""
+    groups = {}
+    for index, image in enumerate(images):
+        groups.setdefault(image.shape, []).append(index)
+    return groups
+
+def collect_images(inputs):
+    """Expand directories and file paths into a sorted image list"""
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths.extend(os.path.join(item, name) for name in sorted(os.listdir(item))
+                         if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            paths.append(item)
+    return paths
+
+def output_names(paths):
+    """Stem of every path, with the lowest free _2, _3, ... suffix where an earlier path has the same stem"""
+    used = set()
+    names = []
+    for path in paths:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        name, count = stem, 1
+        while name in used:
+            count += 1
+            name = f"{stem}_{count}"
+        used.add(name)
+        names.append(name)
+    return names
+
+def process_chunk(paths, output_dir=None, include_features=False, fast=False, budget=65536, min_confidence=0.95,
+                  max_pixels=STACK_PIXELS, names=None):
+    """Estimate and remove the noise of a chunk of image files in a worker process
+
+    Images of the same size are loaded straight into a shared stack and
+    handled in one vectorized pass once it is full. Stacks pending at the
+    same time hold at most `max_pixels` pixels together, plus one image if a
+    single image is larger. With `fast` images are classified by
+    estimate_noise_sampled() and records carry its confidence and whether
+    sampling sufficed. Denoised images are written to `output_dir` as
+    <name>_denoised.png, taking the names from `names` or else from
+    output_names(). Returns one record per path, in order.
+    """
+    records = [{'path': path} for path in paths]
+    names = names or output_names(paths)
+    pending = {}
+
+    def flush(shape):
+        stack, members = pending.pop(shape)
+        stack = stack[:len(members)]
+        if fast:
+            noise_types, features, confidence, sampled = estimate_noise_sampled(
+                stack, budget=budget, min_confidence=min_confidence)
+        else:
+            features = extract_features(stack)
+            noise_types = classify(features)
+        denoised = remove_noise(stack, noise_types) if output_dir is not None else None
+
+        for position, index in enumerate(members):
+            record = records[index]
+            record.update(status='ok', height=shape[0], width=shape[1], noise_type=str(noise_types[position]))
+            if fast:
+                record.update(confidence=float(confidence[position]), sampled=bool(sampled[position]))
+            if include_features:
+                record['features'] = {name: float(features[name][position]) for name in FEATURE_NAMES}
+            if denoised is not None:
+                output_path = os.path.join(output_dir, f"{names[index]}_denoised.png")
+                cv2.imwrite(output_path, to_uint8(denoised[position]))
+                record['output'] = output_path
+
+    for index, path in enumerate(paths):
+        try:
+            image = load_image(path)
+        except Exception as e:
+            records[index].update(status='error', error=f"{type(e).__name__}: {str(e)}")
+            continue
+
+        if image.shape not in pending:
+            # Size the new stack to the budget left by the other pending stacks and to the remaining paths
+            held = sum(stack[0].size * len(stack) for stack, _ in pending.values())
+            capacity = max(1, min(len(paths) - index, (max_pixels - held) // image.size))
+            pending[image.shape] = (np.empty((capacity,) + image.shape), [])
+
+        stack, members = pending[image.shape]
+        stack[len(members)] = image
+        members.append(index)
+        if len(members) == len(stack):
+            flush(image.shape)
+
+    for shape in list(pending):
+        flush(shape)
+
+    return records
+
+def run_batch(paths, output_dir=None, results=None, workers=None, chunk_size=32, include_features=False,
+              fast=False, budget=65536, min_confidence=0.95, max_pixels=STACK_PIXELS):
+    """Classify and denoise images across a process pool in chunks, streaming JSONL records
+
+    Each worker receives `chunk_size` paths at a time and stacks their images
+    in passes of at most `max_pixels` pixels, so its memory is bounded by the
+    pixel budget rather than by the size of the images; at most two chunks
+    per worker are in flight. Records are written
+    to `results` (stdout by default) in input order. Returns the number of
+    images that failed.
+    """
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = workers * 2
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    results = results or sys.stdout
+
+    # Same-named inputs, e.g. a/img1.png and b/img1.png, get counter suffixes
+    names = output_names(paths)
+    if output_dir is not None:
+        for path, name in zip(paths, names):
+            if name != os.path.splitext(os.path.basename(path))[0]:
+                print(f"Writing {path} as {name}_denoised.png to avoid overwriting", file=sys.stderr)
+
+    chunks = iter(enumerate((paths[i:i + chunk_size], names[i:i + chunk_size])
+                            for i in range(0, len(paths), chunk_size)))
+    in_flight = {}
+    finished = {}
+    next_index = 0
+    failures = 0
+    exhausted = False
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            while not exhausted and len(in_flight) + len(finished) < max_in_flight:
+                try:
+                    order, (chunk, chunk_names) = next(chunks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                future = pool.submit(process_chunk, chunk, output_dir, include_features, fast, budget,
+                                     min_confidence, max_pixels, chunk_names)
+                in_flight[future] = (order, chunk)
+
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                order, chunk = in_flight.pop(future)
+                try:
+                    finished[order] = future.result()
+                except Exception as e:
+                    finished[order] = [{'path': path, 'status': 'error', 'error': f"{type(e).__name__}: {str(e)}"}
+                                       for path in chunk]
+
+            # Flush completed chunks in input order
+            while next_index in finished:
+                for record in finished.pop(next_index):
+                    if record['status'] != 'ok':
+                        failures += 1
+                    results.write(json.dumps(record) + "\n")
+                results.flush()
+                next_index += 1
+
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Estimate the noise type of images and remove it")
+    parser.add_argument('inputs', nargs='+', help="Image files or directories")
+    parser.add_argument('-o', '--output', help="Directory for denoised images (default: only classify)")
+    parser.add_argument('-r', '--results', help="JSONL file for per-image results (default: stdout)")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--chunk-size', type=int, default=32, help="Images sent to a worker at a time")
+    parser.add_argument('--stack-pixels', type=int, default=STACK_PIXELS,
+                        help="Pixels a worker stacks for one vectorized pass")
+    parser.add_argument('--features', action='store_true', dest='include_features',
+                        help="Include the estimation statistics in each record")
+    parser.add_argument('--fast', action='store_true',
+                        help="Classify from a sample of columns, computing in full only near a threshold")
+    parser.add_argument('--budget', type=int, default=65536, help="Pixels sampled per image with --fast")
+    parser.add_argument('--min-confidence', type=float, default=0.95,
+                        help="Bootstrap agreement below which --fast falls back to the full computation")
+    args = parser.parse_args(argv)
+
+    paths = collect_images(args.inputs)
+    if not paths:
+        parser.error("no images found")
+
+    results = open(args.results, 'w') if args.results else None
+    try:
+        failures = run_batch(paths, args.output, results, workers=args.workers, chunk_size=args.chunk_size,
+                             include_features=args.include_features, fast=args.fast, budget=args.budget,
+                             min_confidence=args.min_confidence, max_pixels=args.stack_pixels)
+    finally:
+        if results:
+            results.close()
+
+    print(f"Processed {len(paths)} images, {failures} failed", file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""
+Noisy test image generation, ported from NoiseGeneration.m
+"""
+
+import argparse
+import os
+import sys
+
+import cv2
+import numpy as np
+
+from noise_estimation import load_image, to_uint8
+
+# Parameters of NoiseGeneration.m. Its "gaussian_variance" is used as the standard deviation.
+SALT_PEPPER_DENSITY = 0.1
+GAUSSIAN_STD = 0.04
+UNIFORM_RANGE = (-0.3, 0.3)
+RAYLEIGH_SCALE = 0.2
+EXP_MEAN = 0.15
+
+# File name suffix of each generated noise type and the noise type it simulates
+NOISE_SUFFIXES = {
+    'sp': 'salt & pepper',
+    'gaussian': 'gaussian',
+    'uniform': 'uniform',
+    'rayleigh': 'rayleigh',
+    'exp': 'exponential',
+}
+
+def add_noise(image, suffix, rng):
+    """Return a [0, 1] image with one kind of noise from NoiseGeneration.m added"""
+    if suffix == 'sp':
+        # imnoise: the lower half of the density becomes pepper, the upper half salt
+        draw = rng.random(image.shape)
+        noisy = image.copy()
+        noisy[draw < SALT_PEPPER_DENSITY / 2] = 0
+        noisy[(draw >= SALT_PEPPER_DENSITY / 2) & (draw < SALT_PEPPER_DENSITY)] = 1
+        return noisy
+
+    if suffix == 'gaussian':
+        noise = GAUSSIAN_STD * rng.standard_normal(image.shape)
+    elif suffix == 'uniform':
+        noise = UNIFORM_RANGE[0] + (UNIFORM_RANGE[1] - UNIFORM_RANGE[0]) * rng.random(image.shape)
+    elif suffix == 'rayleigh':
+        noise = RAYLEIGH_SCALE * np.sqrt(-2 * np.log(1 - rng.random(image.shape)))
+    elif suffix == 'exp':
+        noise = rng.exponential(EXP_MEAN, image.shape)
+    else:
+        raise ValueError(f"Unknown noise type: {suffix}")
+    return np.clip(image + noise, 0, 1)
+
+def make_chessboard(size=512, squares=8, dark=0.0, light=1.0):
+    """Square chessboard image in [0, 1], a stand-in for the board photos used by NoiseGeneration.m"""
+    cells = (np.arange(size) * squares // size)
+    board = (cells[:, None] + cells[None, :]) % 2
+    return np.where(board == 0, light, dark)
+
+def generate(images, output_dir, seed=0):
+    """Write img<N>_<suffix>.png for every image and noise type, returning the written paths
+
+    `images` maps the image number to a [0, 1] grayscale image.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    written = []
+    for number, image in images.items():
+        for suffix in NOISE_SUFFIXES:
+            path = os.path.join(output_dir, f"img{number}_{suffix}.png")
+            cv2.imwrite(path, to_uint8(add_noise(image, suffix, rng)))
+            written.append(path)
+    return written
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate noisy versions of test images")
+    parser.add_argument('inputs', nargs='*', help="Source images (default: synthetic chessboards)")
+    parser.add_argument('-o', '--output', default='noisy_images', help="Output directory")
+    parser.add_argument('-n', '--count', type=int, default=6, help="Number of chessboards without inputs")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed")
+    args = parser.parse_args(argv)
+
+    if args.inputs:
+        images = {number: load_image(path) for number, path in enumerate(args.inputs, start=1)}
+    else:
+        images = {number: make_chessboard(squares=4 + 2 * number) for number in range(1, args.count + 1)}
+
+    written = generate(images, args.output, args.seed)
+    print(f"Wrote {len(written)} noisy images to {args.output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()